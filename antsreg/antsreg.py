@@ -10,13 +10,953 @@
 
 import os
 import sys
+import json
+import zlib
+import errno
+import queue
+import select
+import ctypes
+import ctypes.util
+import gzip
+import struct
+import shutil
+import hashlib
+import socket
 import subprocess
+import threading
+import tempfile
 import time
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from filelock import FileLock
 
+# Optional, mosaics are made by CreateTiledMosaic and ConvertToJpg without them
+try:
+    import numpy as np
+    import nibabel as nib
+    from PIL import Image
+except ImportError:
+    np = None
+
 # Import the Chris app superclass
 from chrisapp.base import ChrisApp
 
+class StagePipeline(object):
+    """
+    Run stages of the registration of several images concurrently.
+    A stage starts as soon as the stages it depends on have finished, with
+    at most max_parallel stages running at the same time. Exclusive stages
+    (the SyN stage, which occupies every worker) run one at a time, in the
+    order they were added, and do not count against max_parallel.
+    Stages may add further stages while the pipeline runs.
+    """
+    def __init__(self, max_parallel):
+        self.max_parallel = max_parallel
+        self.pending      = []      # names of stages not started yet, in the order they were added
+        self.functions    = {}
+        self.dependencies = {}
+        self.after        = {}
+        self.exclusive    = {}
+        self.failed       = {}      # name -> exception, for stages that failed or were skipped
+        self.condition    = threading.Condition()
+
+    def add(self, name, function, depends_on=(), exclusive=False, after=()):
+        """
+        Add stage name, which calls function once every stage in depends_on
+        has finished. Dependencies on stages that were never added are ignored.
+        Stages in after only order the pipeline: name waits for them to be over,
+        but still runs if they failed.
+        """
+        with self.condition:
+            self.pending.append(name)
+            self.functions[name]    = function
+            self.dependencies[name] = [stage for stage in depends_on if stage in self.functions]
+            self.after[name]        = [stage for stage in after if stage in self.functions]
+            self.exclusive[name]    = exclusive
+            self.condition.notify_all()
+
+    def notify(self, future=None):
+        with self.condition:
+            self.condition.notify_all()
+
+    def start_ready_stages(self, executor, running, finished):
+        """
+        Submit every pending stage whose dependencies are met, as long as
+        there is room for it. Must be called holding self.condition.
+        """
+        exclusive_running = any(self.exclusive[name] for name in running.values())
+        parallel_running  = sum(not self.exclusive[name] for name in running.values())
+        for name in list(self.pending):
+            dependencies = self.dependencies[name]
+            if any(stage in self.failed for stage in dependencies):
+                print("PLUGIN ERROR MSG: Skipping {}, a stage it depends on failed."
+                      .format(name))
+                self.failed[name] = RuntimeError('dependency failed')
+                self.pending.remove(name)
+                continue
+            if not all(stage in finished for stage in dependencies) or \
+               not all(stage in finished or stage in self.failed for stage in self.after[name]):
+                if self.exclusive[name]:
+                    # Keep exclusive stages in order
+                    exclusive_running = True
+                continue
+            if self.exclusive[name]:
+                if exclusive_running:
+                    continue
+                exclusive_running = True
+            else:
+                if parallel_running >= self.max_parallel:
+                    continue
+                parallel_running += 1
+            print("PLUGIN DEBUG MSG: Starting pipeline stage {}".format(name))
+            future = executor.submit(self.functions[name])
+            running[future] = name
+            self.pending.remove(name)
+            future.add_done_callback(self.notify)
+
+    def run(self):
+        """
+        Run every stage and return once all of them are finished.
+        Stages depending on a failed stage are skipped; failures are
+        returned as a dict of stage name to exception.
+        """
+        finished = set()
+        running  = {}               # future -> name
+        with ThreadPoolExecutor(max_workers=self.max_parallel + 1) as executor:
+            with self.condition:
+                while True:
+                    for future in [future for future in running if future.done()]:
+                        name = running.pop(future)
+                        if future.exception() is not None:
+                            print("PLUGIN ERROR MSG: Pipeline stage {} failed: {}"
+                                  .format(name, future.exception()))
+                            self.failed[name] = future.exception()
+                        else:
+                            finished.add(name)
+                    self.start_ready_stages(executor, running, finished)
+                    if not self.pending and not running:
+                        break
+                    self.condition.wait()
+        return self.failed
+
+class CommandError(Exception):
+    """
+    Raised when a command exits with a non zero status, runs out of time or
+    cannot be started (start_error, the OSError of Popen).
+    """
+    def __init__(self, argv, returncode, log_file_path, stage='', timed_out=False,
+                 start_error=None):
+        self.argv          = argv
+        self.stage         = stage
+        self.returncode    = returncode
+        self.log_file_path = log_file_path
+        self.timed_out     = timed_out
+        if start_error is not None:
+            reason = 'could not be started ({})'.format(start_error)
+        elif timed_out:
+            reason = 'timed out'
+        else:
+            reason = 'exited with status {}'.format(returncode)
+        Exception.__init__(self, '{} {}, see {}'.format(argv[0], reason, log_file_path))
+
+    def move_log(self, log_file_path):
+        """
+        Point the error at log_file_path, where the log of the command was moved.
+        """
+        self.args = (str(self).replace(self.log_file_path, log_file_path),)
+        self.log_file_path = log_file_path
+
+class CommandEngine(object):
+    """
+    Run commands given as argument vectors, without a shell.
+    At most max_concurrent commands run at the same time (no limit if 0).
+    timeouts maps a stage name, or '*' for every stage, to seconds; a command
+    running longer than the timeout of its stage is killed along with its children.
+    stdout and stderr are streamed line by line to a log file per image in log_path.
+    The commands of an image can be cancelled, see cancel.
+    """
+    def __init__(self, max_concurrent, timeouts, log_path):
+        self.slots     = threading.BoundedSemaphore(max_concurrent) if max_concurrent > 0 else None
+        self.timeouts  = timeouts
+        self.log_path  = log_path
+        self.running   = {}         # process -> log name
+        self.cancelled = set()      # log names whose commands are killed
+        self.lock      = threading.Lock()
+        os.makedirs(log_path, exist_ok=True)
+
+    def cancel(self, log_name):
+        """
+        Kill the running commands logged to log_name, and fail those started
+        with it until uncancel is called.
+        """
+        with self.lock:
+            self.cancelled.add(log_name)
+            processes = [process for process, name in self.running.items() if name == log_name]
+        for process in processes:
+            self.kill(process, threading.Event())
+
+    def uncancel(self, log_name):
+        with self.lock:
+            self.cancelled.discard(log_name)
+
+    def get_timeout(self, stage):
+        return self.timeouts.get(stage, self.timeouts.get('*'))
+
+    def stream_to_log(self, stream, log_file, log_lock, label):
+        for line in iter(stream.readline, b''):
+            with log_lock:
+                log_file.write('[{}] {}'.format(label, line.decode(errors='replace')))
+                log_file.flush()
+        stream.close()
+
+    def run(self, argv, env=None, stage='', log_name=''):
+        """
+        Run argv and return its resource usage (see os.wait4).
+        Raise CommandError if it fails or times out.
+        """
+        if self.slots is not None:
+            self.slots.acquire()
+        try:
+            return self.run_with_slot(argv, env, stage, log_name)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    def run_with_slot(self, argv, env, stage, log_name):
+        log_file_path = '{}/{}.log'.format(self.log_path, log_name or 'antsreg')
+        with open(log_file_path, 'a') as log_file:
+            log_file.write('[{}] $ {}\n'.format(stage, ' '.join(argv)))
+            log_file.flush()
+            with self.lock:
+                if log_name in self.cancelled:
+                    raise CommandError(argv, -1, log_file_path, stage)
+                # New session, so that a timeout kills the children of scripts too
+                try:
+                    process = subprocess.Popen(argv, env=env, stdout=subprocess.PIPE,
+                                               stderr=subprocess.PIPE, start_new_session=True)
+                except OSError as e:
+                    # Missing binary, no permission, out of memory: a failure like any other
+                    log_file.write('[{}] {}\n'.format(stage, e))
+                    raise CommandError(argv, -1, log_file_path, stage, start_error=e) from e
+                self.running[process] = log_name
+            log_lock = threading.Lock()
+            readers = [threading.Thread(target=self.stream_to_log,
+                                        args=(process.stdout, log_file, log_lock, stage)),
+                       threading.Thread(target=self.stream_to_log,
+                                        args=(process.stderr, log_file, log_lock, stage + ' stderr'))]
+            for reader in readers:
+                reader.start()
+            timed_out = threading.Event()
+            timer = None
+            timeout = self.get_timeout(stage)
+            if timeout:
+                timer = threading.Timer(timeout, self.kill, args=(process, timed_out))
+                timer.start()
+            # Reap the process ourselves to get the resource usage of it and its children
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            with self.lock:
+                del self.running[process]
+            if timer is not None:
+                timer.cancel()
+            for reader in readers:
+                reader.join()
+        if timed_out.is_set() or process.returncode != 0:
+            raise CommandError(argv, process.returncode, log_file_path, stage,
+                               timed_out.is_set())
+        return rusage
+
+    def kill(self, process, timed_out):
+        timed_out.set()
+        try:
+            os.killpg(process.pid, 9)
+        except OSError:
+            pass
+
+class MemoryBudget(object):
+    """
+    Admission control of the commands of a worker by their peak memory. A command
+    starts only while its estimate plus the estimates of the commands running fits
+    in limit bytes; waiting commands start in order of arrival, and a command
+    estimated larger than limit starts once it would run alone.
+    Estimates are BASE_BYTES plus bytes per voxel times the voxels of the images
+    of the command. Bytes per voxel of a stage and speed start from
+    DEFAULT_BYTES_PER_VOXEL and are replaced by the largest ratio measured from
+    the max RSS of the completed commands, with SAFETY_MARGIN on top. A ratio
+    measured on small images, whose peak is mostly BASE_BYTES, does not tell the
+    cost of larger ones, so those are never estimated below the default.
+    """
+    BASE_BYTES              = 256 * 1024**2
+    DEFAULT_BYTES_PER_VOXEL = {'linear': 48, 'syn': 128, 'syn_slow': 192,
+                               'dicom_conversion': 16, 'mosaic': 16}
+    SAFETY_MARGIN           = 1.25
+
+    def __init__(self, limit, speed):
+        self.limit     = limit
+        self.speed     = speed
+        self.reserved  = 0
+        self.measured  = {}     # key -> largest bytes per voxel measured
+        self.measured_voxels = {}  # key -> voxels of the largest images measured
+        self.voxels    = 0      # voxels of the largest images seen
+        self.waiting   = []     # arrival order of commands waiting for memory
+        self.condition = threading.Condition()
+
+    def get_key(self, stage):
+        key = '{}_{}'.format(stage, self.speed)
+        if key in self.DEFAULT_BYTES_PER_VOXEL or key in self.measured:
+            return key
+        return stage
+
+    def estimate(self, stage, voxels):
+        """
+        Return the estimated peak memory, in bytes, of a command of stage on
+        images of the given number of voxels (None if unknown).
+        """
+        key = self.get_key(stage)
+        if voxels is None:
+            # Without a size, assume the largest images seen so far
+            voxels = self.voxels
+        bytes_per_voxel = self.DEFAULT_BYTES_PER_VOXEL.get(key, 64)
+        if key in self.measured:
+            measured_bytes_per_voxel = self.measured[key] * self.SAFETY_MARGIN
+            if voxels <= self.measured_voxels[key]:
+                bytes_per_voxel = measured_bytes_per_voxel
+            else:
+                bytes_per_voxel = max(bytes_per_voxel, measured_bytes_per_voxel)
+        return int(self.BASE_BYTES + bytes_per_voxel * voxels)
+
+    def observe(self, stage, voxels, max_rss):
+        """
+        Refine the estimates of stage from the max RSS, in bytes, of a completed
+        command. Return True if the estimate of stage was first measured or grew.
+        """
+        if not voxels:
+            return False
+        key = self.get_key(stage)
+        bytes_per_voxel = (max_rss - self.BASE_BYTES) / voxels
+        with self.condition:
+            self.voxels = max(self.voxels, voxels)
+            if bytes_per_voxel <= 0:
+                # Peak within BASE_BYTES, nothing to learn about the cost per voxel
+                return False
+            self.measured_voxels[key] = max(self.measured_voxels.get(key, 0), voxels)
+            grew = key not in self.measured or bytes_per_voxel > self.measured[key]
+            if grew:
+                self.measured[key] = bytes_per_voxel
+            # A smaller estimate may let waiting commands start
+            self.condition.notify_all()
+        return grew
+
+    def acquire(self, amount):
+        """
+        Wait until amount bytes may be reserved and reserve them.
+        Return the time spent waiting.
+        """
+        start_time = time.time()
+        with self.condition:
+            ticket = object()
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or \
+                  (self.reserved > 0 and self.reserved + amount > self.limit):
+                self.condition.wait()
+            self.waiting.pop(0)
+            self.reserved += amount
+            self.condition.notify_all()
+        return time.time() - start_time
+
+    def release(self, amount):
+        with self.condition:
+            self.reserved -= amount
+            self.condition.notify_all()
+
+class CoordinatorError(Exception):
+    """
+    Raised on a slave when the coordinator cannot serve one of its requests.
+    """
+
+class StageCancelled(Exception):
+    """
+    Raised on a worker whose share of a SyN stage was killed because the share
+    of another worker failed. The message is the error of that worker.
+    """
+
+def copy_bytes(reader, writer, size):
+    """
+    Copy exactly size bytes from file object reader to file object writer.
+    """
+    while size > 0:
+        chunk = reader.read(min(size, 1 << 20))
+        if not chunk:
+            raise CoordinatorError('Connection closed in the middle of a file')
+        writer.write(chunk)
+        size -= len(chunk)
+
+class CoordinatorClient(object):
+    """
+    Connection of a slave worker to the coordinator run by master in network
+    coordinator mode, see AntsReg.handle_coordinator_request.
+    A request is a line of JSON with an 'op' field, followed by 'size' bytes
+    of file content if it has a 'size' field; replies have the same form, with
+    an 'error' field if the request failed. Requests of several threads of the
+    worker are sent one at a time.
+    """
+    def __init__(self, address):
+        connection = socket.create_connection(address, timeout=10)
+        connection.settimeout(None)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = connection.makefile('rb')
+        self.writer = connection.makefile('wb')
+        self.lock   = threading.Lock()
+
+    def request(self, op, file_path=None, output_path=None, **fields):
+        """
+        Send request op with fields, and the content of file_path if given.
+        Return the reply. File content sent back is written to output_path.
+        """
+        with self.lock:
+            if file_path is not None:
+                fields["size"] = os.path.getsize(file_path)
+            self.writer.write(json.dumps(dict(fields, op=op)).encode() + b'\n')
+            if file_path is not None:
+                with open(file_path,'rb') as input_file:
+                    shutil.copyfileobj(input_file, self.writer)
+                    input_file.close()
+            self.writer.flush()
+            line = self.reader.readline()
+            if not line:
+                raise CoordinatorError('Lost connection to coordinator')
+            reply = json.loads(line)
+            if "size" in reply:
+                with open(output_path + '.partial','wb') as output_file:
+                    copy_bytes(self.reader, output_file, reply["size"])
+                    output_file.close()
+                os.replace(output_path + '.partial', output_path)
+        if "error" in reply:
+            raise CoordinatorError('{} failed: {}'.format(op, reply["error"]))
+        return reply
+
+class Inotify(object):
+    """
+    Minimal inotify binding through ctypes, used to wake up as soon as
+    something changes in watched directories. Raise OSError if inotify is
+    not available.
+    """
+    EVENTS = 0x2 | 0x4 | 0x8 | 0x80 | 0x100 | 0x200 # modify, attrib, close_write,
+                                                    # moved_to, create, delete
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watched = set()
+
+    def add_watch(self, path):
+        if path in self.watched:
+            return
+        if self.libc.inotify_add_watch(self.fd, path.encode(), self.EVENTS) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on ' + path)
+        self.watched.add(path)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for an event and discard the pending events.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+class InputWatcher(object):
+    """
+    Watch an input directory that is still being filled, e.g. by a scanner.
+    watch() yields the name of each new file or directory once nothing in it
+    changed for settle_time seconds, so that files being written and DICOM
+    series still arriving are not picked up early. Names in ignore and hidden
+    names are skipped. Watching ends once the file named sentinel appears and
+    every entry has settled, or after idle_timeout seconds without any change.
+    Changes are noticed through inotify, or by polling every POLL_INTERVAL
+    seconds where inotify is not available. inotify does not see writes made
+    by other hosts on network file systems, so the directory is also scanned
+    every INOTIFY_POLL_INTERVAL seconds. Scans are at least MIN_SCAN_INTERVAL
+    seconds apart while files are being written.
+    """
+    POLL_INTERVAL         = 2
+    INOTIFY_POLL_INTERVAL = 10
+    MIN_SCAN_INTERVAL     = 0.25
+
+    def __init__(self, path, ignore, settle_time, idle_timeout, sentinel):
+        self.path         = path
+        self.ignore       = set(ignore) | {sentinel}
+        self.settle_time  = settle_time
+        self.idle_timeout = idle_timeout
+        self.sentinel     = sentinel
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(path)
+        except (OSError, AttributeError, TypeError) as e:
+            print("PLUGIN DEBUG MSG: Polling {}, inotify is not available: {}".format(path, e))
+            self.inotify = None
+
+    def get_signature(self, entry_path):
+        """
+        Return what changes when entry_path, or anything in it, is written.
+        """
+        if not os.path.isdir(entry_path):
+            stat = os.stat(entry_path)
+            return (stat.st_size, stat.st_mtime_ns)
+        count, size, mtime = 0, 0, os.stat(entry_path).st_mtime_ns
+        for dir_path, dir_names, file_names in os.walk(entry_path):
+            if self.inotify is not None:
+                self.inotify.add_watch(dir_path)
+            for name in file_names:
+                stat = os.stat(dir_path + '/' + name)
+                count += 1
+                size  += stat.st_size
+                mtime  = max(mtime, stat.st_mtime_ns)
+        return (count, size, mtime)
+
+    def wait(self, timeout):
+        timeout = max(timeout, self.MIN_SCAN_INTERVAL)
+        if self.inotify is not None:
+            start_time = time.time()
+            self.inotify.wait(min(timeout, self.INOTIFY_POLL_INTERVAL))
+            time.sleep(max(0, start_time + self.MIN_SCAN_INTERVAL - time.time()))
+        else:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+
+    def watch(self):
+        emitted       = set()
+        changes       = {}      # name -> [signature, time of its last change]
+        last_activity = time.time()
+        try:
+            while True:
+                done = os.path.exists(self.path + '/' + self.sentinel)
+                now = time.time()
+                for name in sorted(os.listdir(self.path)):
+                    if name in emitted or name in self.ignore or name.startswith('.'):
+                        continue
+                    try:
+                        signature = self.get_signature(self.path + '/' + name)
+                    except OSError:
+                        # Removed or renamed while scanning
+                        continue
+                    if name not in changes or changes[name][0] != signature:
+                        changes[name] = [signature, now]
+                        last_activity = now
+                    elif now - changes[name][1] >= self.settle_time:
+                        del changes[name]
+                        emitted.add(name)
+                        last_activity = now
+                        yield name
+                if not changes and (done or time.time() - last_activity >= self.idle_timeout):
+                    print("PLUGIN DEBUG MSG: Stopped watching {}: {}"
+                          .format(self.path, 'sentinel found' if done else 'idle'))
+                    return
+                if changes:
+                    self.wait(min(changes[name][1] for name in changes)
+                              + self.settle_time - time.time())
+                else:
+                    self.wait(last_activity + self.idle_timeout - time.time())
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+
+def is_nifti_file_name(name):
+    """
+    Return True if name has a .nii or .nii.gz extension.
+    """
+    filename_split = name.strip().split('.')
+    if len(filename_split) > 1 and filename_split[-1] == 'nii':   # .nii extension
+        return True
+    return len(filename_split) > 2 and filename_split[-2] == 'nii' # .nii.gz extension
+
+def parse_timeouts(timeouts_str):
+    """
+    Parse per stage timeouts such as 'syn=14400,linear=3600'. A plain number
+    applies to every stage.
+    """
+    timeouts = {}
+    for item in timeouts_str.split(','):
+        if not item.strip():
+            continue
+        if '=' in item:
+            stage, seconds = item.split('=')
+            timeouts[stage.strip()] = float(seconds)
+        else:
+            timeouts['*'] = float(item)
+    return timeouts
+
+def read_nifti_header(image_path):
+    """
+    Return the dimensions and voxel spacing of a NIfTI-1 or NIfTI-2 image,
+    reading only its header, or None if image_path is not a NIfTI image.
+    """
+    opener = gzip.open if image_path.endswith('.gz') else open
+    try:
+        with opener(image_path, 'rb') as image_file:
+            header = image_file.read(540)
+    except (OSError, EOFError):
+        return None
+    for byte_order in '<>':
+        if len(header) < 348:
+            return None
+        sizeof_hdr = struct.unpack(byte_order + 'i', header[:4])[0]
+        if sizeof_hdr == 348:
+            dim    = struct.unpack(byte_order + '8h', header[40:56])
+            pixdim = struct.unpack(byte_order + '8f', header[76:108])
+            break
+        if sizeof_hdr == 540 and len(header) == 540:
+            dim    = struct.unpack(byte_order + '8q', header[16:80])
+            pixdim = struct.unpack(byte_order + '8d', header[104:168])
+            break
+    else:
+        return None
+    ndim = max(1, min(dim[0], 7))
+    return {"dims":    [int(size) for size in dim[1:ndim + 1]],
+            "spacing": [round(abs(spacing), 4) for spacing in pixdim[1:ndim + 1]]}
+
+def get_image_voxels(image_path_list):
+    """
+    Return the number of voxels of the largest of the NIfTI images in
+    image_path_list, read from their headers, or None if one is not readable.
+    """
+    headers = [read_nifti_header(image_path) for image_path in image_path_list]
+    if None in headers:
+        return None
+    return max(functools.reduce(lambda x, y: x * y, header["dims"], 1)
+               for header in headers)
+
+def get_dicom_dir_voxels(dicom_dir_path):
+    """
+    Return an estimate of the number of voxels in a DICOM directory from the
+    size of its files, assuming 16 bit pixels.
+    """
+    size = 0
+    for name in os.listdir(dicom_dir_path):
+        if os.path.isfile(dicom_dir_path + '/' + name):
+            size += os.path.getsize(dicom_dir_path + '/' + name)
+    return size // 2
+
+def estimate_runtime(completed, size, samples=5):
+    """
+    Return the expected seconds to register an image of size voxels, from the
+    median seconds per voxel of the samples completed images closest in size.
+    completed is a non empty list of (size, seconds).
+    """
+    size = max(size, 1)
+    closest = sorted(completed,
+                     key=lambda done: max(done[0], size) / max(min(done[0], size), 1))[:samples]
+    rates = sorted(seconds / max(done_size, 1) for done_size, seconds in closest)
+    return max(rates[len(rates) // 2] * size, 1e-3)
+
+def get_cgroup_memory_limit():
+    """
+    Return the memory limit of the cgroup of this process in bytes, or None
+    if it has none.
+    """
+    for limit_file_path in ('/sys/fs/cgroup/memory.max',
+                            '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(limit_file_path) as limit_file:
+                limit = limit_file.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports no limit as a number close to 2^63
+        if limit.isdigit() and int(limit) < 1 << 60:
+            return int(limit)
+        return None
+    return None
+
+def plan_threads(voxels, threads_per_worker, max_workers, voxels_per_thread):
+    """
+    Return the number of threads of a single worker stage and the number of
+    workers and total threads of a process parallel stage registering an image
+    of the given number of voxels. Each thread gets at least voxels_per_thread
+    voxels, so that small images do not spend their time synchronizing threads
+    and workers. voxels_per_thread = 0 or an unknown number of voxels uses
+    every thread and worker.
+    """
+    if voxels_per_thread <= 0 or voxels is None:
+        needed_threads = threads_per_worker * max_workers
+    else:
+        needed_threads = max(1, -(-voxels // voxels_per_thread))
+    single_threads = min(threads_per_worker, needed_threads)
+    workers        = max(1, min(max_workers, -(-needed_threads // threads_per_worker)))
+    if workers == 1:
+        return single_threads, 1, single_threads
+    return single_threads, workers, workers * threads_per_worker
+
+class JobManifest(object):
+    """
+    Record of the stages completed for every image of a batch, kept in the
+    output directory so that a run restarted after a crash skips the work
+    already done. Stages are 'converted' (DICOM directories, with the list of
+    volumes produced), 'linear', 'syn' and 'thumbnail'; 'source' identifies
+    the moving image the stages were run on.
+    The manifest is written to a temporary file and renamed into place on
+    every update, so it is never seen half written. It only applies to runs
+    with the same settings, a run with other settings starts a new one.
+    """
+    def __init__(self, manifest_path, lock_path, settings):
+        self.manifest_path = manifest_path
+        self.settings      = settings
+        self.lock          = FileLock(lock_path)
+        self.thread_lock   = threading.Lock()  # FileLock does not exclude threads of a process
+
+    def read(self):
+        try:
+            with open(self.manifest_path,'r') as manifest_file:
+                manifest = json.load(manifest_file)
+                manifest_file.close()
+        except (FileNotFoundError, ValueError):
+            manifest = None
+        if manifest is None or manifest.get("settings") != self.settings:
+            return {"settings": self.settings, "images": {}}
+        return manifest
+
+    def get(self, image):
+        """
+        Return the completed stages of image, as a dict of stage to value.
+        """
+        return self.read()["images"].get(image, {})
+
+    def mark(self, image, **stages):
+        """
+        Record stages of image, given as stage=value, e.g. syn=True.
+        """
+        with self.thread_lock, self.lock.acquire():
+            manifest = self.read()
+            manifest["images"].setdefault(image, {}).update(stages)
+            with open(self.manifest_path + '.partial','w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+                manifest_file.close()
+            os.replace(self.manifest_path + '.partial', self.manifest_path)
+
+def get_file_signature(file_path):
+    """
+    Return the size and modification time of file_path, which tell whether a
+    file changed between runs without reading it.
+    """
+    stat = os.stat(file_path)
+    return [stat.st_size, int(stat.st_mtime)]
+
+def parse_size(size_str):
+    """
+    Return the number of bytes in a Kubernetes style size string such as
+    '10Gi', '500Mi' or '1000'.
+    """
+    units = {'Ki': 1024, 'Mi': 1024**2, 'Gi': 1024**3, 'Ti': 1024**4,
+             'K': 1000, 'M': 1000**2, 'G': 1000**3, 'T': 1000**4}
+    for unit in sorted(units, key=len, reverse=True):
+        if size_str.endswith(unit):
+            return int(float(size_str[:-len(unit)]) * units[unit])
+    return int(size_str)
+
+def gzip_file(in_file_path, out_file_path, threads, chunk_size=1 << 24):
+    """
+    Compress in_file_path into out_file_path with gzip, using up to threads
+    threads. Every chunk of the input is compressed into a gzip member of its
+    own; gzip readers read the concatenated members as a single file.
+    """
+    def compress(chunk):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)     # gzip wrapper
+        return compressor.compress(chunk) + compressor.flush()
+    with open(in_file_path,'rb') as in_file, open(out_file_path,'wb') as out_file, \
+         ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        empty = True
+        while True:
+            # At most one chunk per thread in memory
+            chunks = [chunk for chunk in (in_file.read(chunk_size) for _ in range(threads))
+                      if chunk]
+            if not chunks:
+                break
+            for data in executor.map(compress, chunks):
+                out_file.write(data)
+            empty = False
+        if empty:
+            out_file.write(compress(b''))
+
+def publish_file(file_path, out_file_path):
+    """
+    Move file_path to out_file_path, which appears complete at once, also when
+    both are on different file systems.
+    """
+    try:
+        os.replace(file_path, out_file_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        partial_file_path = '{}/.{}.partial'.format(os.path.dirname(out_file_path),
+                                                    os.path.basename(out_file_path))
+        shutil.copyfile(file_path, partial_file_path)
+        os.replace(partial_file_path, out_file_path)
+        os.remove(file_path)
+
+def hash_file(file_path):
+    """
+    Return the sha256 hex digest of the content of file_path.
+    """
+    sha = hashlib.sha256()
+    with open(file_path,'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+        f.close()
+    return sha.hexdigest()
+
+def render_mosaic_jpeg(in_file_path, out_file_path, quality=90):
+    """
+    Write a JPEG mosaic of the axial slices of the volume in in_file_path,
+    tiled in a square grid, like CreateTiledMosaic followed by ConvertToJpg.
+    The volume is memory mapped when it is not compressed, and intensities are
+    rescaled to 8 bits between the 0.5 and 99.5 percentiles.
+    Requires numpy, nibabel and Pillow.
+    """
+    image = nib.load(in_file_path, mmap=True)
+    data = np.asanyarray(image.dataobj)
+    while data.ndim > 3:
+        data = data[..., 0]
+    # (x, y, z) -> (z, rows, columns), with anterior up as in radiological display
+    slices = np.rot90(data, axes=(0, 1)).transpose(2, 0, 1)
+    number_of_slices, height, width = slices.shape
+    columns = int(np.ceil(np.sqrt(number_of_slices)))
+    rows = int(np.ceil(number_of_slices / columns))
+    low, high = np.percentile(slices, [0.5, 99.5])
+    scale = 255.0 / (high - low) if high > low else 0.0
+    tiles = np.zeros((rows * columns, height, width), dtype=np.uint8)
+    tiles[:number_of_slices] = np.clip((slices - low) * scale, 0, 255).astype(np.uint8)
+    mosaic = tiles.reshape(rows, columns, height, width).swapaxes(1, 2) \
+                  .reshape(rows * height, columns * width)
+    Image.fromarray(mosaic, 'L').save(out_file_path, 'JPEG', quality=quality)
+
+class RegistrationCache(object):
+    """
+    Persistent cache of registration results, shared by all workers and runs.
+    An entry is a directory named after the hash of the content of the fixed
+    and moving images and of the registration parameters. Entries are written
+    to a temporary directory and renamed into place, so readers never see a
+    partial entry. The cache is kept under max_bytes by evicting the least
+    recently used entries; the modification time of an entry is its last use.
+    """
+    def __init__(self, cache_path, max_bytes):
+        self.cache_path = cache_path
+        self.max_bytes  = max_bytes
+        self.file_hashes = {}       # file path -> content hash, files are hashed once per run
+        self.lock = FileLock(cache_path + '/cache.lock')
+        os.makedirs(cache_path, exist_ok=True)
+
+    def get_file_hash(self, file_path):
+        if file_path not in self.file_hashes:
+            self.file_hashes[file_path] = hash_file(file_path)
+        return self.file_hashes[file_path]
+
+    def get_key(self, file_path_list, params):
+        """
+        Return the key of the entry for the files in file_path_list processed
+        with params, a JSON serializable dict.
+        """
+        sha = hashlib.sha256()
+        for file_path in file_path_list:
+            sha.update(self.get_file_hash(file_path).encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the directory of entry key, or None if it is not cached.
+        """
+        entry_path = '{}/{}'.format(self.cache_path, key)
+        with self.lock.acquire():
+            if not os.path.isdir(entry_path):
+                return None
+            os.utime(entry_path)
+        return entry_path
+
+    def store(self, key, files):
+        """
+        Store files, a dict of name in the entry -> path of the file to store,
+        as entry key. Files that do not exist are skipped.
+        """
+        entry_path = '{}/{}'.format(self.cache_path, key)
+        partial_path = '{}/.{}.{}.partial'.format(self.cache_path, key, os.getpid())
+        os.makedirs(partial_path, exist_ok=True)
+        for name, file_path in files.items():
+            if os.path.isfile(file_path):
+                shutil.copy2(file_path, partial_path + '/' + name)
+        with self.lock.acquire():
+            if os.path.isdir(entry_path):
+                # Another worker stored the same result first
+                shutil.rmtree(partial_path)
+            else:
+                os.rename(partial_path, entry_path)
+            self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        Must be called holding self.lock.
+        """
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.cache_path):
+            entry_path = self.cache_path + '/' + name
+            if name.startswith('.') or not os.path.isdir(entry_path):
+                continue
+            entry_bytes = sum(os.path.getsize(entry_path + '/' + f) for f in os.listdir(entry_path))
+            entries.append((os.path.getmtime(entry_path), entry_bytes, entry_path))
+            total_bytes += entry_bytes
+        for _, entry_bytes, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            print("PLUGIN DEBUG MSG: Evicting {} from registration cache".format(entry_path))
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_bytes -= entry_bytes
+
+    def restore(self, key, files):
+        """
+        Make the files of entry key available at the paths given by files, a dict
+        of name in the entry -> destination path. Files are hard linked when the
+        cache is on the same filesystem, copied otherwise.
+        Return False if the entry disappeared in the meantime.
+        """
+        entry_path = '{}/{}'.format(self.cache_path, key)
+        try:
+            for name, file_path in files.items():
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                try:
+                    os.link(entry_path + '/' + name, file_path)
+                except OSError:
+                    shutil.copy2(entry_path + '/' + name, file_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+def timed_stage(stage, image_arg=0):
+    """
+    Decorator recording every call of an AntsReg method as stage in the timeline.
+    The positional argument at index image_arg identifies the image: either a
+    file path or ants args holding name_wo_ext.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            image = args[image_arg] if len(args) > image_arg else ''
+            if isinstance(image, dict):
+                image = image.get("name_wo_ext", '')
+            with self.stage_timer(stage, str(image).split('/')[-1]):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 class AntsReg(ChrisApp):
     """
     A plugin app for registration using ants.
@@ -50,6 +990,12 @@ class AntsReg(ChrisApp):
     IDLE  = 0
     START = 1
     EXIT  = 2
+    QUEUE = 3   # slaves pull whole moving images from the work queue
+
+    # Scheduling modes
+    SCHEDULE_SYN   = 'syn'     # all workers cooperate on the SyN stage of one image
+    SCHEDULE_IMAGE = 'image'   # each worker registers whole images from a shared queue
+    SCHEDULE_AUTO  = 'auto'
 
     # Files for interworker communication 
     tmp_path                  = ''      # temporary folder to be removed at end of execution
@@ -58,312 +1004,2698 @@ class AntsReg(ChrisApp):
     slave_state_file_path     = ''      # file used to send signals to slaves
     slave_state_file_lock     = None
     args_file_path            = ''      # file used to send args to slaves to be passed to ants
+    work_queue_file_path      = ''      # file holding moving images not yet claimed by a worker
+    work_queue_file_lock      = None
+    master_address_file_path  = ''      # file holding host and port of the master's signal channel
+    polling_workers_file_path = ''      # file listing slaves that could not reach the signal channel
+
+    # Event-driven signal channel. Master listens on a TCP socket and pushes states
+    # to connected slaves; the files above remain the fallback protocol.
+    master_socket             = None    # listening socket (master only)
+    slave_connections         = []      # socket files of connected slaves (master only)
+    channel_condition         = None    # notified whenever a slave connects or reports
+    master_connection         = None    # socket file connected to master (slave only)
+    master_state              = 0       # last state broadcast to slaves (master only)
+    heartbeat_file_path       = ''      # touched by master while it runs
+    HEARTBEAT_INTERVAL        = 5       # seconds between two heartbeats of master
+    HEARTBEAT_TIMEOUT         = 30      # seconds without heartbeat after which master is dead
+    SYN_CANCEL_POLL_INTERVAL  = 2       # seconds between checks for a failed share of SyN
+    JOIN_POLL_INTERVAL        = 0.5     # seconds between checks for polling slaves while joining
+    SIDE_THREADS_SHARE        = 4       # master keeps 1/4 of its threads next to SyN
+    manifest                  = None    # JobManifest of the batch
+    coordinator_address       = None    # (host, port) of the coordinator in network mode
+    coordinator               = None    # CoordinatorClient (slaves in network mode only)
+    next_worker_num           = 1       # next worker number given out by the coordinator
+    staged_files              = {}      # coordinator path -> local copy (slaves in network mode)
+    staging_roots             = []      # directories slaves may fetch files from (master)
+    out_path                  = ''      # output directory of master
+    thread_locks              = {}      # lock file -> RLock, see locked
+    join_deadline             = 60      # seconds master waits for every worker to join
     ants_registration_command = 'antsRegistrationSyNQuick.sh'
+    registration_cache        = None    # RegistrationCache, None when caching is disabled
+    affine_init               = False   # pass the affine transform to the SyN stage
+    keep_intermediate         = False   # keep the output of the linear stage in affine_init mode
+    worker_num                = 0
+    background_executor       = None    # thread making mosaics off the registration path
+    timeline_file_path        = ''      # JSON lines, one record per stage run by any worker
+    command_engine            = None    # CommandEngine running every external command
+    memory_budget             = None    # MemoryBudget admitting commands, None if unlimited
+    scratch_path              = None    # private scratch directory of this worker, see --scratchdir
+    voxels_per_thread         = 0       # minimum voxels per thread, see plan_threads
+    speculation_factor        = 0       # see --speculate, 0 when disabled
+    stage_local               = threading.local()   # stage record of the current thread
+    background_futures        = []
+
+    # Duplicate registrations of stragglers, see choose_straggler
+    SPECULATION_MIN_SAMPLES   = 2       # images registered before runtimes are expected
+    SPECULATION_MIN_SECONDS   = 30      # images running less are never duplicated
+    SPECULATION_POLL_INTERVAL = 2       # seconds between checks for a faster duplicate
+
+    # Names of the files of a registration cache entry
+    CACHED_OUTPUTS    = ['Warped.nii.gz', 'WarpedTiled.jpg']
+    CACHED_TRANSFORMS = ['Linear0GenericAffine.mat', '0GenericAffine.mat',
+                         '1Warp.nii.gz', '1InverseWarp.nii.gz']
+    # Suffixes of the files the stages of an image write next to its outputs
+    STAGE_OUTPUTS     = ['Warped.nii.gz', 'InverseWarped.nii.gz', 'LinearWarped.nii.gz',
+                         'LinearInverseWarped.nii.gz'] + CACHED_TRANSFORMS
+
+    def define_parameters(self):
+        """
+        -f filename for fixed image. All other files in the input 
+        directory will be interpreted as moving images.
+
+        -s set "speed"
+           set to fast to run antsRegistrationSyNQuick.sh
+           set to slow to run antsRegistrationSyN.sh
+
+        -p set scheduling policy
+           set to syn to register images one at a time, with all workers
+              cooperating on the SyN stage of each image
+           set to image to let every worker register whole images pulled
+              from a shared work queue (largest images first)
+           set to auto (default) to pick image when there are at least as
+              many moving images as workers, and syn otherwise
+
+        -c set the maximum number of DICOM directories converted at the same
+           time. Defaults to one per CPU of the worker, or with -p syn to the
+           quarter of them master keeps next to its share of the SyN stages,
+           where the linear stage of the next image and mosaics also run.
+           With fewer than 4 CPUs per worker, master keeps none: with -p syn,
+           DICOM directories are converted before registration starts and
+           linear stages wait for the SyN stage of the previous image.
+
+        --cachedir directory holding registration results from previous runs,
+           keyed on the content of the fixed and moving images and on the
+           registration parameters. Images already registered are copied
+           from the cache instead of being registered again.
+
+           The cache also holds what is prepared from the fixed image, keyed on
+           its content: the volume converted from a fixed DICOM directory and
+           FixedTiled.jpg, so that jobs sharing an atlas or reference image skip
+           preparing it. A fixed image restored from the cache also keeps the
+           registration cache keys of its moving images the same across runs.
+
+        --cachesize maximum size of the cache, e.g. 20Gi. Least recently used
+           results are evicted first.
+
+        --affineinit keep the transform found by the linear stages and pass it
+           to the SyN stage as initial transform of the original moving image,
+           instead of resampling the moving image in between. Saves a resample,
+           a gzip round trip and interpolation blur per image.
+
+        --keepintermediate keep the moving image resampled by the linear stages
+           as <prefix>LinearWarped.nii.gz, which is otherwise removed once the
+           SyN stage succeeds. With --affineinit, also write it.
+
+        --watch keep watching the input directory for moving images still being
+           written, e.g. by a scanner, and register each one as soon as it is
+           complete instead of waiting for the whole study. A NIFTI file or DICOM
+           directory is complete once nothing in it changed for --settletime
+           seconds; hidden files are ignored until renamed. The fixed image must be
+           in the input directory from the start. Watching ends once the file named
+           --sentinel appears in the input directory and every image in it is
+           complete, or after --idletimeout seconds without any change. With -p auto,
+           images are registered one at a time with every worker (-p syn), since they
+           arrive one at a time.
+
+        --settletime seconds without change after which an input is complete in
+           watch mode. Defaults to 10.
+
+        --idletimeout seconds without any change in the input directory after which
+           watch mode ends. Defaults to 600.
+
+        --sentinel name of the file marking the end of the study in watch mode.
+           Defaults to "DONE".
+
+        --coordinator host:port of the network coordinator, the same for every
+           worker. The worker that can bind this address becomes master and runs
+           a small TCP service that gives out worker numbers, broadcasts state,
+           hands out images and stages input and output files, so workers on
+           different nodes cooperate without a shared file system. The other
+           workers connect to it and register images in a local scratch
+           directory. Images are always scheduled to whole workers in this mode
+           (see -p), because the process parallel SyN stage of ITK synchronizes
+           workers through shared files.
+
+        --joindeadline seconds master waits for all NUMBER_OF_WORKERS workers to
+           join. After that it starts with the workers that have joined; workers
+           joining later take part in the work queue right away and in SyN stages
+           from the next image on.
+
+        --voxelsperthread minimum number of voxels per thread. The threads of
+           a stage, and the workers sharing the SyN stage, are chosen per image
+           from the header of the fixed and moving images so that every thread
+           gets at least this many voxels: a 64^3 volume is registered by a single
+           worker with 8 threads rather than spread over every worker. Set to 0
+           to always use every thread and worker. The choice made for each image
+           is in the output meta data under 'allocation'.
+
+        --maxcommands maximum number of external commands (ants, dcm2niix, ...)
+           a worker runs at the same time. 0 for no limit.
+
+        --scratchdir directory for the intermediate files of a worker, preferably
+           on node local disk or in memory, e.g. /dev/shm. Every worker uses a
+           directory of its own in it, removed when the worker exits. The linear
+           and SyN stages then call antsRegistration directly and write uncompressed
+           images, which are compressed by pigz, or by a pool of threads if pigz is
+           not installed, in the background while the next image is registered, and
+           moved into the output directory once complete. With -p syn, the output
+           of the linear stage is read by every worker and stays in the output
+           directory, compressed, while the SyN stage writes to the scratch
+           directory of each worker.
+
+        --memorylimit memory the commands of a worker may use at the same time,
+           e.g. 10Gi. Defaults to 90% of the MEMORY_LIMIT environment variable, of
+           the memory limit of the container or of MAX_MEMORY_LIMIT, the rest being
+           left to the plugin itself. The peak memory of each command is estimated
+           from the size of its images and the speed (-s), and refined from the
+           max RSS of the commands already run; a command starts only once its
+           estimate fits next to the commands running. Set to 0 to start commands
+           regardless of memory. The estimates measured are in the output meta data
+           under 'memory'.
+
+        --timeouts seconds after which the command of a stage is killed and the
+           image reported as failed, e.g. "syn=14400,linear=3600". Stages are
+           dicom_conversion, linear, syn and mosaic. A single number applies to
+           every stage. No timeout by default.
+
+        --speculate with -p image, once no image is left in the work queue, an idle
+           worker starts a duplicate registration of a running image that takes
+           more than this many times longer than expected, e.g. 2. The runtime
+           expected is the median time per voxel of the registered images closest
+           in size. The first registration to complete the SyN stage wins, the
+           other one is killed and its outputs discarded. At most one duplicate per
+           image. Idle workers check for stragglers every few seconds until the last
+           image is registered. 0, the default, disables it. The duplicates started
+           are in the output meta data under 'speculation'.
+
+        Define more parameters here as needed.
+        """
+        self.add_argument('-f', dest='fixed', type=str, optional=False,
+                          help='The filename for the fixed image.')
+        self.add_argument('-s', dest='speed', type=str, optional=True, 
+                          default='antsRegistrationSyNQuick.sh',
+                          help='Set to "fast" or "slow" depending on speed and quality desired.')
+        self.add_argument('-c', dest='conversion_jobs', type=int, optional=True,
+                          default=0,
+                          help='Maximum number of DICOM directories converted at the same '
+                               'time, 0 for one per CPU (a quarter of them with -p syn, '
+                               'if at least 4).')
+        self.add_argument('--cachedir', dest='cachedir', type=str, optional=True,
+                          default='',
+                          help='Directory of the registration cache, shared across runs. '
+                               'Caching is disabled if not set.')
+        self.add_argument('--cachesize', dest='cachesize', type=str, optional=True,
+                          default='20Gi',
+                          help='Maximum size of the registration cache, e.g. 20Gi.')
+        self.add_argument('--affineinit', dest='affine_init', type=bool, optional=True,
+                          default=False,
+                          help='Pass the affine transform to the SyN stage instead of '
+                               'resampling the moving image after the linear stage.')
+        self.add_argument('--keepintermediate', dest='keep_intermediate', type=bool,
+                          optional=True, default=False,
+                          help='Keep the output of the linear stage as '
+                               '<prefix>LinearWarped.nii.gz, also writing it with --affineinit.')
+        self.add_argument('--maxcommands', dest='max_commands', type=int, optional=True,
+                          default=4,
+                          help='Maximum number of external commands a worker runs at the '
+                               'same time, 0 for no limit.')
+        self.add_argument('--scratchdir', dest='scratch_dir', type=str, optional=True,
+                          default='',
+                          help='Directory for uncompressed intermediate files, e.g. /dev/shm. '
+                               'Outputs are compressed in the background.')
+        self.add_argument('--memorylimit', dest='memory_limit', type=str, optional=True,
+                          default='',
+                          help='Memory the commands of a worker may use at the same time, '
+                               'e.g. 10Gi, 0 for no limit. Defaults to 90% of the memory '
+                               'limit of the worker.')
+        self.add_argument('--timeouts', dest='timeouts', type=str, optional=True,
+                          default='',
+                          help='Seconds after which a stage is killed, e.g. '
+                               '"syn=14400,linear=3600", or one number for every stage.')
+        self.add_argument('--watch', dest='watch', type=bool, optional=True,
+                          default=False,
+                          help='Register moving images as they arrive in the input directory.')
+        self.add_argument('--settletime', dest='settle_time', type=float, optional=True,
+                          default=10,
+                          help='Seconds without change after which an input is complete '
+                               'in watch mode.')
+        self.add_argument('--idletimeout', dest='idle_timeout', type=float, optional=True,
+                          default=600,
+                          help='Seconds without new input after which watch mode ends.')
+        self.add_argument('--sentinel', dest='sentinel', type=str, optional=True,
+                          default='DONE',
+                          help='Name of the file marking the end of the study in watch mode.')
+        self.add_argument('--coordinator', dest='coordinator', type=str, optional=True,
+                          default='',
+                          help='host:port of the network coordinator. Workers then coordinate '
+                               'over TCP and need no shared file system.')
+        self.add_argument('--joindeadline', dest='join_deadline', type=float, optional=True,
+                          default=60,
+                          help='Seconds master waits for every worker to join before starting '
+                               'with the workers it has.')
+        self.add_argument('--voxelsperthread', dest='voxels_per_thread', type=int,
+                          optional=True, default=32768,
+                          help='Minimum number of voxels per thread, which limits the threads '
+                               'and workers used for small images. 0 to always use all of them.')
+        self.add_argument('--speculate', dest='speculation_factor', type=float,
+                          optional=True, default=0,
+                          help='With -p image, duplicate a registration running this many '
+                               'times longer than expected on an idle worker, e.g. 2. '
+                               'Disabled by default.')
+        self.add_argument('-p', dest='schedule', type=str, optional=True,
+                          default=self.SCHEDULE_AUTO,
+                          help='Set to "syn", "image" or "auto" to choose how work is '
+                               'distributed among workers.')
+
+    @timed_stage('rendezvous')
+    def get_worker_number(self):
+        """
+        Get the next available worker number.
+        worker numbers range from 0 to NUMBER_OF_WORKERS-1.
+        Create file 'worker_num_sync' in tmp_path, which is used
+        to synchronize worker number assignment among available workeres.
+        A worker restarted right after a crash finds the files of the crashed run,
+        with worker numbers out of range or a master that is gone: it gives its
+        number back and waits for the heartbeat of that master to go stale, after
+        which the files are removed, see recover_stale_tmp.
+        Return the worker number.
+        """
+        NUMBER_OF_WORKERS = int(os.environ['NUMBER_OF_WORKERS'])
+        while True:
+            worker_num = self.take_worker_number()
+            self.worker_num = worker_num
+            if worker_num == 0:
+                break
+            if worker_num < NUMBER_OF_WORKERS:
+                # Slaves start waiting for master's signals right away, over the signal
+                # channel if possible, otherwise by polling slave_state.
+                if self.connect_to_master():
+                    break
+                if self.master_is_alive():
+                    print("PLUGIN DEBUG MSG: Master is alive, falling back to file polling.")
+                    self.add_polling_worker()
+                    break
+            self.give_back_worker_number(worker_num)
+            print("PLUGIN DEBUG MSG: Worker number {} is out of range or master is gone, "
+                  "waiting for the files of a previous run to go stale ...".format(worker_num))
+            time.sleep(self.HEARTBEAT_INTERVAL)
+        print('PLUGIN DEBUG MSG: Assigned worker Number {}.'.format(worker_num))
+        if worker_num != 0:
+            return worker_num
+        # Master waits for every worker until join_deadline, then starts with the
+        # workers it has. Late workers are folded in as they arrive.
+        if self.master_socket is not None:
+            self.wait_for_slave_connections(NUMBER_OF_WORKERS - 1, self.join_deadline)
+        else:
+            start_time = time.time()
+            while self.get_present_workers() < NUMBER_OF_WORKERS and \
+                  time.time() - start_time < self.join_deadline:
+                time.sleep(0.1)
+            self.record_wait(time.time() - start_time)
+        present_workers = self.get_present_workers()
+        if present_workers < NUMBER_OF_WORKERS:
+            print("PLUGIN DEBUG MSG: {} of {} workers joined, starting without the others."
+                  .format(present_workers, NUMBER_OF_WORKERS))
+        return worker_num
+
+    def take_worker_number(self):
+        """
+        Return the next worker number from 'worker_num_sync', creating it and
+        starting the master's signal channel and heartbeat if this worker is first.
+        The files of a crashed run are removed first, see recover_stale_tmp.
+        """
+        worker_num = 0
+        with self.locked(self.worker_num_file_lock):
+            if os.path.exists(self.worker_num_file_path) and self.master_is_dead():
+                self.recover_stale_tmp()
+            try:
+                with open(self.worker_num_file_path,'x') as worker_num_file:
+                    # Current worker is assigned 0, next worker is assigned 1.
+                    worker_num_file.write('1') 
+                    worker_num_file.close()
+                    worker_num = 0
+                    print("PLUGIN DEBUG MSG: {} not found. Assuming that I'm first, \
+                           so I'm assigning myself #0 and declaring \
+                           my self as master.".format(self.worker_num_file_path))
+                # Publish the signal channel while still holding the lock, so that
+                # every worker that gets a number after us can find it.
+                self.start_master_channel()
+                # Start a fresh timeline before any other worker writes to it
+                open(self.timeline_file_path,'w').close()
+                self.start_heartbeat()
+            except FileExistsError:
+                with open(self.worker_num_file_path,'r+') as worker_num_file:
+                    # Read worker number and overwrite with next worker number
+                    worker_num = int(worker_num_file.read().strip())
+                    worker_num_file.seek(0)
+                    worker_num_file.write(str(worker_num + 1))
+                    worker_num_file.truncate()
+                    worker_num_file.close()
+        return worker_num
+
+    def give_back_worker_number(self, worker_num):
+        """
+        Undo take_worker_number, unless other workers took a number since
+        or the files were recovered.
+        """
+        with self.locked(self.worker_num_file_lock):
+            try:
+                with open(self.worker_num_file_path,'r+') as worker_num_file:
+                    if int(worker_num_file.read().strip()) == worker_num + 1:
+                        worker_num_file.seek(0)
+                        worker_num_file.write(str(worker_num))
+                        worker_num_file.truncate()
+                    worker_num_file.close()
+            except FileNotFoundError:
+                pass
+
+    @timed_stage('rendezvous')
+    def join_coordinator(self, address):
+        """
+        Network coordinator mode, used instead of get_worker_number.
+        The worker that can bind address (host:port) becomes master and serves
+        worker numbers, state, images and files to the others over TCP, see
+        handle_coordinator_request. The others connect to it, retrying until
+        join_deadline, and stage files in a temporary directory of their own.
+        Return the worker number.
+        """
+        NUMBER_OF_WORKERS = int(os.environ['NUMBER_OF_WORKERS'])
+        host, port = address.rsplit(':', 1)
+        self.coordinator_address = (host, int(port))
+        try:
+            master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            master_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            master_socket.bind(self.coordinator_address)
+            master_socket.listen(NUMBER_OF_WORKERS)
+        except OSError:
+            # Address in use by master, or on another host
+            master_socket = None
+        if master_socket is not None:
+            self.worker_num = 0
+            print("PLUGIN DEBUG MSG: Bound coordinator address {}, I am master.".format(address))
+            # Nobody else uses the tmp_path of master in this mode, whatever is left
+            # there is from a previous run
+            os.makedirs(self.tmp_path, exist_ok=True)
+            with self.locked(self.worker_num_file_lock):
+                self.recover_stale_tmp()
+            open(self.timeline_file_path,'w').close()
+            self.start_master_channel(master_socket)
+            self.wait_for_slave_connections(NUMBER_OF_WORKERS - 1, self.join_deadline)
+            return 0
+        start_time = time.time()
+        while True:
+            try:
+                connection = socket.create_connection(self.coordinator_address, timeout=10)
+                break
+            except OSError as e:
+                if time.time() - start_time > self.join_deadline:
+                    print("PLUGIN ERROR MSG: Could not reach coordinator at {}: {}"
+                          .format(address, e))
+                    sys.exit(1)
+                time.sleep(0.1)
+        self.record_wait(time.time() - start_time)
+        connection.settimeout(None)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.master_connection = connection.makefile('rw')
+        self.master_connection.write(json.dumps({"op": "join"}) + '\n')
+        self.master_connection.flush()
+        reply = json.loads(self.master_connection.readline() or '{"error": "connection lost"}')
+        if "error" in reply:
+            raise ValueError('PLUGIN ERROR MSG: Coordinator refused to give a worker number: '
+                             + reply["error"])
+        self.worker_num  = reply["worker_num"]
+        self.coordinator = CoordinatorClient(self.coordinator_address)
+        self.staged_files = {}
+        self.tmp_path = tempfile.mkdtemp(prefix='antsreg_w{}_'.format(self.worker_num))
+        os.mkdir(self.tmp_path + '/out')
+        print('PLUGIN DEBUG MSG: Assigned worker Number {} by coordinator, staging files in {}.'
+              .format(self.worker_num, self.tmp_path))
+        return self.worker_num
+
+    def master_is_dead(self):
+        """
+        Return True if master has not shown a sign of life for HEARTBEAT_TIMEOUT
+        seconds, meaning the coordination files in tmp_path are left over from
+        a run that crashed.
+        """
+        try:
+            return time.time() - os.path.getmtime(self.heartbeat_file_path) > \
+                   self.HEARTBEAT_TIMEOUT
+        except FileNotFoundError:
+            return True
+
+    def master_is_alive(self):
+        """
+        Return True if master touches the heartbeat file within two
+        HEARTBEAT_INTERVAL. The heartbeat of a master that just crashed is
+        recent, so master_is_dead does not tell yet, but it no longer changes.
+        """
+        try:
+            last_beat = os.path.getmtime(self.heartbeat_file_path)
+            deadline = time.time() + 2 * self.HEARTBEAT_INTERVAL
+            while time.time() < deadline:
+                time.sleep(0.5)
+                if os.path.getmtime(self.heartbeat_file_path) != last_beat:
+                    return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    def recover_stale_tmp(self):
+        """
+        Must be called holding worker_num_file_lock.
+        Remove the coordination files of a crashed run from tmp_path so that
+        this run starts afresh. Lock files and the directories of converted
+        DICOM volumes, which the job manifest may refer to, are kept.
+        """
+        print("PLUGIN DEBUG MSG: Master of a previous run is gone, "
+              "removing its coordination files from {}".format(self.tmp_path))
+        for name in os.listdir(self.tmp_path):
+            file_path = self.tmp_path + '/' + name
+            if name.endswith('.lock') or os.path.isdir(file_path):
+                continue
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def start_heartbeat(self):
+        """
+        Should only be called by master worker.
+        Touch the heartbeat file every HEARTBEAT_INTERVAL seconds until tmp_path
+        is removed, so that workers can tell a running master from a crashed one.
+        """
+        open(self.heartbeat_file_path,'w').close()
+        def beat():
+            while True:
+                time.sleep(self.HEARTBEAT_INTERVAL)
+                try:
+                    os.utime(self.heartbeat_file_path)
+                except FileNotFoundError:
+                    return
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+
+    def get_present_workers(self):
+        """
+        Should only be called by master worker.
+        Return the number of workers that can take part in a SyN stage now:
+        master, the slaves connected to its signal channel and the slaves that
+        fell back to file polling or, without a signal channel, every worker
+        that got a worker number.
+        """
+        if self.master_socket is not None:
+            polling_workers = self.get_polling_workers()
+            with self.channel_condition:
+                return 1 + len(self.slave_connections) + len(polling_workers)
+        with self.locked(self.worker_num_file_lock):
+            with open(self.worker_num_file_path,'r') as worker_num_file:
+                present_workers = int(worker_num_file.read().strip())
+                worker_num_file.close()
+        return present_workers
+
+    def add_polling_worker(self):
+        """
+        Should only be called by slave workers that could not connect to master.
+        Add the worker number to file 'polling_workers' in tmp_path, next to
+        worker_num_sync, so that master counts this worker in although its
+        signal channel is up, see get_polling_workers.
+        """
+        with self.locked(self.worker_num_file_lock):
+            with open(self.polling_workers_file_path,'a') as polling_workers_file:
+                polling_workers_file.write('{}\n'.format(self.worker_num))
+                polling_workers_file.close()
+
+    def get_polling_workers(self):
+        """
+        Return the sorted worker numbers of the slaves that fell back to file
+        polling, see add_polling_worker.
+        """
+        with self.locked(self.worker_num_file_lock):
+            try:
+                with open(self.polling_workers_file_path,'r') as polling_workers_file:
+                    polling_workers = sorted(int(worker_num)
+                                             for worker_num in polling_workers_file.read().split())
+                    polling_workers_file.close()
+            except FileNotFoundError:
+                polling_workers = []
+        return polling_workers
+
+    def get_syn_ranks(self, planned_workers):
+        """
+        Should only be called by master worker.
+        Choose the workers of a SyN stage of up to planned_workers workers.
+        Slaves that poll take part with the file protocol rank, their worker
+        number, so only those numbered below the number of workers do; the
+        slaves connected to the signal channel take the other ranks, see
+        broadcast_state. Return the number of workers and the worker numbers
+        of the polling slaves taking part.
+        """
+        if self.master_socket is None:
+            number_of_workers = min(planned_workers, self.get_present_workers())
+            return number_of_workers, list(range(1, number_of_workers))
+        polling_workers = self.get_polling_workers()
+        with self.channel_condition:
+            connected_slaves = len(self.slave_connections)
+        number_of_workers = min(planned_workers, 1 + connected_slaves + len(polling_workers))
+        while True:
+            polling_ranks = [worker_num for worker_num in polling_workers
+                             if worker_num < number_of_workers]
+            if number_of_workers - 1 - len(polling_ranks) <= connected_slaves:
+                return number_of_workers, polling_ranks
+            number_of_workers -= 1
+
+    @timed_stage('cleanup')
+    def exit_worker(self, exit_process=True):
+        """
+        Exit the current worker. Decrement the worker_num_sync file.
+        If the worker is the last to leave, then remove tmp directory.
+        Master passes exit_process=False so that run returns normally and
+        output meta data can be saved.
+        """
+        print("PLUGIN DEBUG MSG: exiting ... ")
+        if self.scratch_path is not None:
+            shutil.rmtree(self.scratch_path, ignore_errors=True)
+        if self.coordinator_address is not None:
+            # Nobody shares tmp_path in network coordinator mode
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+            if exit_process:
+                sys.exit()
+            return
+        with self.locked(self.worker_num_file_lock):
+            with open(self.worker_num_file_path,'r+') as worker_num_file:
+                # Read worker number and overwrite with decremented worker number
+                worker_num = int(worker_num_file.read().strip())
+                worker_num_file.seek(0)
+                worker_num_file.write(str(worker_num - 1))
+                worker_num_file.truncate()
+                worker_num_file.close()
+        if worker_num == 1:
+            subprocess.run(['rm','-rf',self.tmp_path])
+        if exit_process:
+            sys.exit()
+
+    @timed_stage('linear')
+    def linear_ants_registration_command_wrapper(self,args,env=None):
+        """
+        Run ants registration command (Rigid and Affine stages only).
+        Output will be named <name_wo_ext>LinearWarped.nii.gz, so that it is not
+        taken for a registered image if the SyN stage fails.
+        env, if given, is the environment of the ants process.
+      
+        Prerequisites:
+         * args.keys() = [fixed_image_name,moving_image_name,out_path,name_wo_ext,total_threads]
+         * be master worker
+        """
+        print("PLUGIN DEBUG MSG: Starting linear ants registration stages ... ")
+        if env is None:
+            env = dict(os.environ)
+        env['ITK_NUMBER_OF_WORKERS'] = args["number_of_workers"]
+        if args.get("affine_init") or self.scratch_path is not None:
+            self.affine_ants_registration_command_wrapper(args, env)
+        else:
+            self.script_linear_ants_registration_command_wrapper(args, env)
+        self.manifest.mark(args["name_wo_ext"], linear=True,
+                           source=self.get_source_signature(args["moving_image_name"]))
+
+    def script_linear_ants_registration_command_wrapper(self, args, env):
+        """
+        Run the linear stages with the registration script, which leaves
+        the moving image resampled by the affine transform in
+        <name_wo_ext>LinearWarped.nii.gz.
+        """
+        # Ants Registration Call 
+        self.run_command_wrapper([self.ants_registration_command,
+                                  '-d', '3',
+                                  '-f', args["fixed_image_name"],
+                                  '-m', args["moving_image_name"],
+                                  '-o', args["out_path"] + '/' + args["name_wo_ext"] + 'Linear',
+                                  '-n', args["total_threads"],
+                                  '-t', 'a'],
+                                 env, args["name_wo_ext"],
+                                 get_image_voxels([args["fixed_image_name"],
+                                                   args["moving_image_name"]]))
+        # Remove extra outputs
+        prefix = args["out_path"] + '/' + args["name_wo_ext"] + 'Linear'
+        files_to_be_removed = [prefix + 'InverseWarped.nii.gz']
+        if not args.get("keep_transforms"):
+            files_to_be_removed.append(prefix + '0GenericAffine.mat')
+        for filename in files_to_be_removed:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def affine_ants_registration_command_wrapper(self,args,env):
+        """
+        Run the Rigid and Affine stages of the ants registration script by calling
+        antsRegistration directly, so that only the transform is written:
+        <name_wo_ext>Linear0GenericAffine.mat. The moving image resampled by that
+        transform is written as <name_wo_ext>LinearWarped.nii.gz only if
+        keep_intermediate is set, or if the SyN stage starts from it rather than
+        from the transform (no affine_init, with a scratch directory). It is
+        written uncompressed, as .nii, if args["uncompressed"] is set.
+        Parameters follow antsRegistrationSyNQuick.sh and antsRegistrationSyN.sh.
+        """
+        fixed  = args["fixed_image_name"]
+        moving = args["moving_image_name"]
+        prefix = args["out_path"] + '/' + args["name_wo_ext"] + 'Linear'
+        if self.ants_registration_command == 'antsRegistrationSyN.sh':
+            convergence = '[1000x500x250x100,1e-6,10]'
+        else:
+            convergence = '[1000x500x250x0,1e-6,10]'
+        output = prefix
+        if self.keep_intermediate or not args.get("affine_init"):
+            output = '[{},{}Warped{}]'.format(prefix, prefix,
+                                              '.nii' if args.get("uncompressed")
+                                              else '.nii.gz')
+        stage = ['--metric', 'MI[{},{},1,32,Regular,0.25]'.format(fixed, moving),
+                 '--convergence', convergence,
+                 '--shrink-factors', '8x4x2x1',
+                 '--smoothing-sigmas', '3x2x1x0vox']
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = args["total_threads"]
+        # Ants Registration Call 
+        self.run_command_wrapper(['antsRegistration', '--verbose', '1',
+                                  '--dimensionality', '3',
+                                  '--collapse-output-transforms', '1',
+                                  '--output', output,
+                                  '--interpolation', 'Linear',
+                                  '--use-histogram-matching', '0',
+                                  '--winsorize-image-intensities', '[0.005,0.995]',
+                                  '--initial-moving-transform', '[{},{},1]'.format(fixed, moving),
+                                  '--transform', 'Rigid[0.1]'] + stage +
+                                 ['--transform', 'Affine[0.1]'] + stage,
+                                 env, args["name_wo_ext"], get_image_voxels([fixed, moving]))
+        if not args.get("affine_init") and not args.get("keep_transforms"):
+            # The SyN stage starts from the resampled image
+            os.remove(prefix + '0GenericAffine.mat')
+
+    @timed_stage('syn')
+    def syn_ants_registration_command_wrapper(self,args):
+        """
+        Run ants registration command (SyN stage only).
+        Output will be named <name_wo_ext>Warped.nii.gz
+
+        Prerequisites:
+         * args.keys() = [fixed_image_name,moving_image_name,out_path,name_wo_ext,total_threads,
+                          number_of_workers]
+         * slave workers get args from master, see receive_state and read_args_from_file
+        """
+        print("PLUGIN DEBUG MSG: Starting SyN ants registration stage ... ")
+        env = dict(os.environ)
+        env['ITK_NUMBER_OF_WORKERS'] = args["number_of_workers"]
+        if "rank" in args:
+            env['ITK_WORKER_NUMBER'] = str(args["rank"])
+        if self.scratch_path is not None:
+            self.direct_syn_ants_registration_command_wrapper(args, env)
+        else:
+            initial_transform_option = []
+            if args.get("initial_transform"):
+                initial_transform_option = ['-i', args["initial_transform"]]
+            # Ants Registration Call 
+            self.run_command_wrapper([self.ants_registration_command,
+                                      '-d', '3',
+                                      '-f', args["fixed_image_name"],
+                                      '-m', args["moving_image_name"],
+                                      '-o', args["out_path"] + '/' + args["name_wo_ext"],
+                                      '-n', args["total_threads"],
+                                      '-t', 'so'] + initial_transform_option,
+                                     env, args["name_wo_ext"],
+                                     get_image_voxels([args["fixed_image_name"],
+                                                       args["moving_image_name"]]))
+        # Remove extra outputs, transforms are removed once stored in the registration cache
+        prefix = (self.scratch_path or args["out_path"]) + '/' + args["name_wo_ext"]
+        files_to_be_removed = [prefix + 'InverseWarped.nii.gz']
+        if not args.get("initial_transform") and not self.keep_intermediate:
+            # Output of the linear stage
+            files_to_be_removed.append(args["moving_image_name"])
+        if not args.get("keep_transforms"):
+            if args.get("initial_transform"):
+                files_to_be_removed.append(args["initial_transform"])
+            files_to_be_removed += [prefix + '1InverseWarp.nii.gz',
+                                    prefix + '1Warp.nii.gz',
+                                    prefix + '0GenericAffine.mat']
+        for filename in files_to_be_removed:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    def direct_syn_ants_registration_command_wrapper(self, args, env):
+        """
+        Run the SyN stage of the ants registration script by calling antsRegistration
+        directly, so that the registered image is written uncompressed, as
+        <name_wo_ext>Warped.nii, and the inverse warped image not at all.
+        Used with a scratch directory, where the outputs are written even if the
+        inputs are in the output directory (-p syn), see publish_registration.
+        Parameters follow antsRegistrationSyNQuick.sh and antsRegistrationSyN.sh.
+        """
+        fixed  = args["fixed_image_name"]
+        moving = args["moving_image_name"]
+        prefix = self.scratch_path + '/' + args["name_wo_ext"]
+        if self.ants_registration_command == 'antsRegistrationSyN.sh':
+            metric      = 'CC[{},{},1,4]'.format(fixed, moving)
+            convergence = '[100x70x50x20,1e-6,10]'
+        else:
+            metric      = 'MI[{},{},1,32]'.format(fixed, moving)
+            convergence = '[100x70x50x0,1e-6,10]'
+        initial_transform = args.get("initial_transform") or '[{},{},1]'.format(fixed, moving)
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = args["total_threads"]
+        # Ants Registration Call 
+        self.run_command_wrapper(['antsRegistration', '--verbose', '1',
+                                  '--dimensionality', '3',
+                                  '--collapse-output-transforms', '1',
+                                  '--output', '[{},{}Warped.nii]'.format(prefix, prefix),
+                                  '--interpolation', 'Linear',
+                                  '--use-histogram-matching', '0',
+                                  '--winsorize-image-intensities', '[0.005,0.995]',
+                                  '--initial-moving-transform', initial_transform,
+                                  '--transform', 'SyN[0.1,3,0]',
+                                  '--metric', metric,
+                                  '--convergence', convergence,
+                                  '--shrink-factors', '8x4x2x1',
+                                  '--smoothing-sigmas', '3x2x1x0vox'],
+                                 env, args["name_wo_ext"], get_image_voxels([fixed, moving]))
+
+    def get_state(self):
+        """
+        Return the state of slave workeres (as given by master), either IDLE, EXIT, or START.
+        All slaves read from the same state file 'slave_state' in tmp_path.
+        This function should only be called by slave workeres.
+        """
+        with self.locked(self.slave_state_file_lock):
+            with open(self.slave_state_file_path,'r') as slave_state_file:
+                state = int(slave_state_file.read().strip())
+                slave_state_file.close()
+        return state
+
+    def write_state(self, state, args=None):
+        """
+        Write the state to the slave sate file in tmp_path 'slave_state'
+        and push it, together with args, to every connected slave.
+        State must be EXIT, START, QUEUE or IDLE.
+        Should only be called by master worker.
+        """
+        with self.locked(self.slave_state_file_lock):
+            with open(self.slave_state_file_path,'w') as slave_state_file:
+                slave_state_file.write(str(state))
+                slave_state_file.close()
+        self.broadcast_state(state, args)
+
+    def start_master_channel(self, master_socket=None):
+        """
+        Should only be called by master worker.
+        Open the TCP socket slaves connect to and publish its address in
+        'master_address' in tmp_path. A TCP socket is used rather than a Unix
+        domain socket because workers may run on different hosts that only
+        share the output directory.
+        In network coordinator mode, master_socket is already bound to the
+        coordinator address, which every worker knows.
+        """
+        self.slave_connections = []
+        self.channel_condition = threading.Condition()
+        if master_socket is not None:
+            self.master_socket = master_socket
+            accept_thread = threading.Thread(target=self.accept_slave_connections, daemon=True)
+            accept_thread.start()
+            return
+        try:
+            host = os.environ.get('ANTSREG_MASTER_HOST',
+                                  socket.gethostbyname(socket.gethostname()))
+            self.master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.master_socket.bind((host, 0))
+            self.master_socket.listen(int(os.environ['NUMBER_OF_WORKERS']))
+        except OSError as e:
+            print("PLUGIN DEBUG MSG: Could not open signal channel ({}), "
+                  "falling back to file polling.".format(e))
+            self.master_socket = None
+            return
+        with open(self.master_address_file_path + '.partial','w') as address_file:
+            address_file.write('{} {}'.format(*self.master_socket.getsockname()))
+            address_file.close()
+        os.replace(self.master_address_file_path + '.partial', self.master_address_file_path)
+        accept_thread = threading.Thread(target=self.accept_slave_connections, daemon=True)
+        accept_thread.start()
+
+    def accept_slave_connections(self):
+        """
+        Runs in a background thread of the master worker.
+        Accept slaves and listen to the messages they send back.
+        """
+        while True:
+            try:
+                connection, _ = self.master_socket.accept()
+            except OSError:
+                return  # socket closed by master
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection_file = connection.makefile('wb')
+            if self.coordinator_address is None:
+                # In network coordinator mode, slaves join with a request instead
+                self.add_slave_connection(connection_file)
+            reader_thread = threading.Thread(target=self.read_slave_messages,
+                                             args=(connection, connection_file),
+                                             daemon=True)
+            reader_thread.start()
+
+    def add_slave_connection(self, connection_file):
+        """
+        Should only be called by master worker.
+        Start sending state to a newly connected slave.
+        """
+        with self.channel_condition:
+            self.slave_connections.append(connection_file)
+            if self.master_state == self.QUEUE:
+                # Late joiner, let it help with the images left in the work queue.
+                # It joins SyN stages from the next image on.
+                self.send_state(connection_file, self.QUEUE)
+            self.channel_condition.notify_all()
+
+    def read_slave_messages(self, connection, connection_file):
+        """
+        Runs in a background thread of the master worker, one per slave connection.
+        Requests of slaves in network coordinator mode are served here; every
+        message from a slave wakes up whoever waits on channel_condition.
+        """
+        reader = connection.makefile('rb')
+        try:
+            for line in reader:
+                message = json.loads(line)
+                if "op" in message:
+                    self.handle_coordinator_request(message, reader, connection_file)
+                with self.channel_condition:
+                    self.channel_condition.notify_all()
+        except (OSError, ValueError, CoordinatorError):
+            pass
+        with self.channel_condition:
+            if connection_file in self.slave_connections:
+                self.slave_connections.remove(connection_file)
+            self.channel_condition.notify_all()
+
+    def wait_for_slave_connections(self, number_of_slaves, timeout):
+        """
+        Should only be called by master worker.
+        Block until number_of_slaves slaves are connected to the signal channel
+        or fell back to file polling, see add_polling_worker.
+        Return False if the channel is not available or timeout expired, in which
+        case the caller falls back to file polling.
+        """
+        if self.master_socket is None:
+            return False
+        start_time = time.time()
+        while True:
+            # Polling slaves only show up in a file, look for them every JOIN_POLL_INTERVAL
+            polling_slaves = len(self.get_polling_workers())
+            remaining = start_time + timeout - time.time()
+            with self.channel_condition:
+                connected = self.channel_condition.wait_for(
+                                lambda: len(self.slave_connections) + polling_slaves
+                                        >= number_of_slaves,
+                                max(0, min(remaining, self.JOIN_POLL_INTERVAL)))
+            if connected or remaining <= self.JOIN_POLL_INTERVAL:
+                break
+        self.record_wait(time.time() - start_time)
+        return connected
+
+    def broadcast_state(self, state, args=None):
+        """
+        Should only be called by master worker.
+        Push state and args to every connected slave as one line of JSON.
+        START only goes to the slaves taking part in the SyN stage, the
+        first ones to have joined, with their rank (ITK_WORKER_NUMBER)
+        for this stage added to args. The ranks of the polling slaves
+        taking part are skipped.
+        """
+        if self.master_socket is None:
+            return
+        with self.channel_condition:
+            self.master_state = state
+            if state == self.START:
+                polling_workers = args.get("polling_workers", '').split(',')
+                ranks = [rank for rank in range(1, int(args["number_of_workers"]))
+                         if str(rank) not in polling_workers]
+                for rank, connection_file in zip(ranks, list(self.slave_connections)):
+                    self.send_state(connection_file, state, dict(args, rank=rank))
+            else:
+                for connection_file in list(self.slave_connections):
+                    self.send_state(connection_file, state, args)
+        if state == self.EXIT:
+            self.master_socket.close()
+
+    def send_state(self, connection_file, state, args=None):
+        """
+        Should only be called by master worker, holding channel_condition.
+        Send state and args to one slave, dropping it if it is gone.
+        """
+        try:
+            connection_file.write(json.dumps({"state": state, "args": args or {}}).encode()
+                                  + b'\n')
+            connection_file.flush()
+        except OSError:
+            self.slave_connections.remove(connection_file)
+
+    def handle_coordinator_request(self, message, reader, connection_file):
+        """
+        Runs in the reader thread of a slave connection on master, in network
+        coordinator mode. Serve one request of a slave, see CoordinatorClient:
+         * join: give out the next worker number and start sending state
+         * update_work_queue: claim the next image, see update_work_queue
+         * claim_job: complete an image unless a duplicate did first, see claim_job
+         * job_state: winner and workers of an image, see get_job_state
+         * get_file: send an input file
+         * put_file: receive an output file, path relative to the output directory
+         * report, timeline: record a report or timeline record of the slave
+         * completed_stages: stages of an image completed by a previous run
+         * image_done: record in the job manifest that an image was registered
+        """
+        op = message["op"]
+        reply = {}
+        file_path = None
+        try:
+            if op == 'join':
+                with self.channel_condition:
+                    if self.next_worker_num >= int(os.environ['NUMBER_OF_WORKERS']):
+                        reply["error"] = 'all {} worker numbers are taken' \
+                                         .format(os.environ['NUMBER_OF_WORKERS'])
+                    else:
+                        reply["worker_num"] = self.next_worker_num
+                        self.next_worker_num += 1
+                    connection_file.write(json.dumps(reply).encode() + b'\n')
+                    connection_file.flush()
+                if "worker_num" in reply:
+                    self.add_slave_connection(connection_file)
+                return
+            elif op == 'put_file':
+                self.receive_staged_file(reader, message["path"], message["size"])
+            elif op == 'get_file':
+                file_path = self.get_staged_file_path(message["path"])
+                reply["size"] = os.path.getsize(file_path)
+            elif op == 'update_work_queue':
+                reply["job"] = self.update_work_queue(message["finished_job"],
+                                                      message.get("worker"))
+            elif op == 'claim_job':
+                reply["won"] = self.claim_job_for_worker(message["moving_image_name"],
+                                                         message["worker"])
+            elif op == 'job_state':
+                reply["winner"], reply["workers"] = \
+                    self.get_job_state(message["moving_image_name"])
+            elif op == 'report':
+                self.write_report(message["report"])
+            elif op == 'timeline':
+                self.write_timeline_record(message["record"])
+            elif op == 'completed_stages':
+                reply["stages"] = sorted(self.get_completed_stages(message["moving_image_name"],
+                                                                   self.out_path))
+            elif op == 'image_done':
+                self.mark_staged_registration(message["moving_image_name"])
+            else:
+                reply["error"] = 'unknown request ' + op
+        except (OSError, ValueError, KeyError) as e:
+            reply = {"error": str(e)}
+            file_path = None
+        connection_file.write(json.dumps(reply).encode() + b'\n')
+        if file_path is not None:
+            with open(file_path,'rb') as input_file:
+                shutil.copyfileobj(input_file, connection_file)
+                input_file.close()
+        connection_file.flush()
+
+    def get_staged_file_path(self, file_path):
+        """
+        Should only be called by master worker.
+        Return file_path if slaves may fetch it: only inputs and converted volumes are served.
+        """
+        real_path = os.path.realpath(file_path)
+        if not any(real_path.startswith(os.path.realpath(root) + '/')
+                   for root in self.staging_roots):
+            raise ValueError('{} is not an input file'.format(file_path))
+        return real_path
+
+    def receive_staged_file(self, reader, relative_path, size):
+        """
+        Should only be called by master worker.
+        Write size bytes read from a slave to relative_path in the output directory.
+        The file is renamed into place once complete.
+        """
+        out_file_path = os.path.normpath(os.path.join(self.out_path, relative_path))
+        if not out_file_path.startswith(os.path.normpath(self.out_path) + '/'):
+            with open(os.devnull,'wb') as null_file:
+                copy_bytes(reader, null_file, size)
+            raise ValueError('{} is outside of the output directory'.format(relative_path))
+        os.makedirs(os.path.dirname(out_file_path), exist_ok=True)
+        with open(out_file_path + '.partial','wb') as out_file:
+            copy_bytes(reader, out_file, size)
+            out_file.close()
+        os.replace(out_file_path + '.partial', out_file_path)
+
+    def mark_staged_registration(self, moving_image_name):
+        """
+        Should only be called by master worker.
+        Record in the job manifest the stages of an image registered by a slave
+        in network coordinator mode whose outputs were sent back.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        prefix = '{}/{}'.format(self.out_path, name_wo_ext)
+        self.manifest.mark(name_wo_ext, linear=True,
+                           syn=os.path.exists(prefix + 'Warped.nii.gz'),
+                           thumbnail=os.path.exists(prefix + 'WarpedTiled.jpg'),
+                           source=self.get_source_signature(moving_image_name))
+
+    def connect_to_master(self):
+        """
+        Should only be called by slave workers.
+        Connect to the master's signal channel. Return False if it is not
+        available, in which case the file protocol is used if master is alive.
+        """
+        try:
+            with open(self.master_address_file_path,'r') as address_file:
+                host, port = address_file.read().split()
+                address_file.close()
+            connection = socket.create_connection((host, int(port)), timeout=10)
+        except (OSError, ValueError) as e:
+            print("PLUGIN DEBUG MSG: Could not connect to master ({}).".format(e))
+            self.master_connection = None
+            return False
+        connection.settimeout(None)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.master_connection = connection.makefile('rw')
+        return True
+
+    def receive_state(self):
+        """
+        Should only be called by slave workers connected to master.
+        Block until master pushes a new state. Return (state, args).
+        If master goes away without saying so, behave as if EXIT was sent.
+        """
+        line = self.master_connection.readline()
+        if not line:
+            print("PLUGIN ERROR MSG: Lost connection to master.")
+            return self.EXIT, {}
+        message = json.loads(line)
+        return message["state"], message["args"]
+
+    def send_to_master(self, message):
+        """
+        Should only be called by slave workers.
+        Report back to master, e.g. when done with the work queue.
+        """
+        if self.master_connection is None:
+            return
+        try:
+            self.master_connection.write(json.dumps(message) + '\n')
+            self.master_connection.flush()
+        except OSError:
+            pass
+
+    def run_parallel_ants_registration_slave(self):
+        """
+        Must be called by slave workeres.
+        This function never returns, it exits python normally when an EXIT signal
+        is sent by the master worker.
+        The slave waits for START signal from master before running ants registration.
+        Signals are received through the master's socket when connected, otherwise
+        by polling the slave_state file.
+        """
+        state = self.IDLE
+        while self.master_connection is not None and state != self.EXIT:
+            with self.stage_timer('wait_for_master') as record:
+                state, args = self.receive_state()
+                record["wait"] = time.time() - record["start"]
+            if state == self.START and self.is_syn_participant(args):
+                try:
+                    self.run_shared_syn_stage(args)
+                except StageCancelled:
+                    pass
+                except Exception as e:
+                    self.record_failure(args["name_wo_ext"], 'syn', e)
+            elif state == self.QUEUE:
+                self.run_work_queue_worker()
+                self.send_to_master({"queue_done": True})
+        if state == self.EXIT:
+            self.exit_worker()
+        last_stage = None
+        while state != self.EXIT:
+            try:
+            	state = self.get_state()
+            except FileNotFoundError:
+                # Most likely because master hasn't created slave_state file yet
+                pass
+            if self.master_is_dead():
+                print("PLUGIN ERROR MSG: Master stopped without saying so, exiting.")
+                break
+            if state == self.START:
+                args = self.read_args_from_file()
+                # Master may end a stage and start the next one between two polls,
+                # so stages are told apart by image rather than by waiting for IDLE
+                if args["name_wo_ext"] != last_stage and self.is_syn_participant(args):
+                    try:
+                        self.run_shared_syn_stage(args)
+                    except StageCancelled:
+                        pass
+                    except Exception as e:
+                        self.record_failure(args["name_wo_ext"], 'syn', e)
+                last_stage = args["name_wo_ext"]
+            elif state == self.QUEUE:
+                self.run_work_queue_worker()
+                # Wait for master to leave queue mode
+                while state == self.QUEUE:
+                    state = self.get_state()
+                    time.sleep(1)
+                continue
+            print("PLUGIN DEBUG MSG: Waiting for master ... ")
+            time.sleep(1)
+        self.exit_worker()
+
+    def write_args_to_file(self, args):
+        """
+        Should only be called by master worker.
+        This method writes the arguments that need to be passed to the ants registration
+        command to file names 'args_file' so that slave workeres know what args to pass.
+        """
+        # Slaves polling slave_state may read args at any time, never show them half written
+        with open(self.args_file_path + '.partial','w') as args_file:
+            args_file.write(args["fixed_image_name"])
+            args_file.write('\n')
+            args_file.write(args["moving_image_name"])
+            args_file.write('\n')
+            args_file.write(args["out_path"])
+            args_file.write('\n')
+            args_file.write(args["name_wo_ext"])
+            args_file.write('\n')
+            args_file.write(args["total_threads"])
+            args_file.write('\n')
+            args_file.write(args.get("initial_transform", ''))
+            args_file.write('\n')
+            args_file.write(args["number_of_workers"])
+            args_file.write('\n')
+            args_file.write(args.get("polling_workers", ''))
+            args_file.write('\n')
+            args_file.close()
+        os.replace(self.args_file_path + '.partial', self.args_file_path)
+
+    def read_args_from_file(self):
+        """
+        Should only be called by slave workers.
+        Return the args of the SyN stage written by master with write_args_to_file.
+        """
+        args = {}
+        with open(self.args_file_path,'r') as args_file:
+            # Lines may be empty, including the last one
+            args_list = args_file.read().split('\n')
+            args["fixed_image_name"]  = args_list[0]
+            args["moving_image_name"] = args_list[1]
+            args["out_path"]          = args_list[2]
+            args["name_wo_ext"]       = args_list[3]
+            args["total_threads"]     = args_list[4]
+            if args_list[5]:
+                args["initial_transform"] = args_list[5]
+            args["number_of_workers"] = args_list[6]
+            args["polling_workers"]   = args_list[7]
+            args_file.close()
+        return args
+
+    def is_syn_participant(self, args):
+        """
+        Return whether this worker takes part in the SyN stage given by args.
+        Master only sends START over the signal channel to the slaves taking
+        part, with their rank. Slaves polling slave_state take part if their
+        worker number, which is their rank, is listed in polling_workers.
+        """
+        if "rank" in args:
+            return True
+        return str(self.worker_num) in args.get("polling_workers", '').split(',')
+        
+    def run_parallel_ants_registration_master(self, linear_ants_args, syn_ants_args):
+        """
+        Should only be called by master worker. 
+        This is executed when master worker is ready to run ants registration.
+        """
+        # Run Linear stage with single worker
+        self.linear_ants_registration_command_wrapper(linear_ants_args)
+        self.run_parallel_syn_ants_registration_master(syn_ants_args)
+
+    def run_parallel_syn_ants_registration_master(self, syn_ants_args):
+        """
+        Should only be called by master worker.
+        Run the SyN stage with all workers.
+        """
+        planned_workers = int(syn_ants_args["number_of_workers"])
+        number_of_workers, polling_ranks = self.get_syn_ranks(planned_workers)
+        if number_of_workers < planned_workers:
+            # Some workers have not joined yet, they take part from a later image on
+            syn_threads = int(syn_ants_args["total_threads"]) * number_of_workers // planned_workers
+            syn_ants_args = dict(syn_ants_args,
+                                 number_of_workers=str(number_of_workers),
+                                 total_threads=str(syn_threads))
+            self.write_report({"kind":        "allocation",
+                               "image":       syn_ants_args["name_wo_ext"],
+                               "syn_workers": number_of_workers,
+                               "syn_threads": syn_threads})
+        syn_ants_args = dict(syn_ants_args,
+                             polling_workers=','.join(str(rank) for rank in polling_ranks))
+        self.write_args_to_file(syn_ants_args)
+        self.write_state(self.START, syn_ants_args)
+        try:
+            self.run_shared_syn_stage(syn_ants_args)
+        except Exception:
+            if number_of_workers > 1:
+                # Let the other shares see the failure and die before the barriers are reused
+                time.sleep(self.SYN_CANCEL_POLL_INTERVAL)
+                self.reset_barrier_files()
+            raise
+        finally:
+            # Slaves go back to waiting even if this image failed
+            self.write_state(self.IDLE)
+        self.manifest.mark(syn_ants_args["name_wo_ext"], syn=True)
+
+    def run_shared_syn_stage(self, syn_ants_args):
+        """
+        Run the share of this worker of a SyN stage, which may be run by several
+        workers. The shares wait for each other on ITK barriers, so if one fails,
+        the others would wait forever: the failing worker leaves its error in a
+        file of tmp_path, which the other workers check for every
+        SYN_CANCEL_POLL_INTERVAL seconds, then kill their share and raise
+        StageCancelled.
+        """
+        if int(syn_ants_args["number_of_workers"]) < 2:
+            self.syn_ants_registration_command_wrapper(syn_ants_args)
+            return
+        name_wo_ext = syn_ants_args["name_wo_ext"]
+        failure_file_path = '{}/syn_failed_{}'.format(self.tmp_path, name_wo_ext)
+        log_name = '{}.w{}'.format(name_wo_ext, self.worker_num)
+        done = threading.Event()
+        cancelled = threading.Event()
+        def watch():
+            while not done.wait(self.SYN_CANCEL_POLL_INTERVAL):
+                if os.path.exists(failure_file_path):
+                    print("PLUGIN DEBUG MSG: SyN stage of {} failed on another worker, "
+                          "cancelling".format(name_wo_ext))
+                    cancelled.set()
+                    self.command_engine.cancel(log_name)
+                    return
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            self.syn_ants_registration_command_wrapper(syn_ants_args)
+        except Exception as e:
+            # Whatever the error, the other shares must not be left on the barriers
+            if cancelled.is_set():
+                with open(failure_file_path) as failure_file:
+                    raise StageCancelled(failure_file.read()) from e
+            with open(failure_file_path + '.partial', 'w') as failure_file:
+                failure_file.write(str(e))
+            os.replace(failure_file_path + '.partial', failure_file_path)
+            raise
+        finally:
+            done.set()
+            watcher.join()
+            self.command_engine.uncancel(log_name)
+            if self.worker_num != 0 and self.scratch_path is not None:
+                # Only master publishes what the stage wrote to scratch
+                self.remove_stage_files(self.scratch_path, name_wo_ext)
+
+    def run_parallel_ants_registration_master_wrapper(self,
+                                                      fixed_image_name,
+                                                      moving_image_name,
+                                                      out_path):
+        """
+        Wrapper function that does preprocessing and postprocessing before 
+        ants registration proper.
+        ust be master to call.
+        """
+        self.configure_env_for_multi_threaded_execution()
+        linear_ants_args, syn_ants_args = self.get_master_ants_args(fixed_image_name,
+                                                                    moving_image_name,
+                                                                    out_path)
+        self.run_parallel_ants_registration_master(linear_ants_args, syn_ants_args)
+        self.make_warped_mosaic(out_path, linear_ants_args["name_wo_ext"], self.scratch_path)
+
+    def get_master_ants_args(self, fixed_image_name, moving_image_name, out_path):
+        """
+        Return the args of the linear stage (single worker) and of the
+        SyN stage (up to all workers) for registering moving_image_name.
+        """
+        return self.get_ants_args(fixed_image_name, moving_image_name, out_path,
+                                  *self.get_allocation(fixed_image_name, moving_image_name,
+                                                       int(os.environ['NUMBER_OF_WORKERS'])))
+
+    def get_allocation(self, fixed_image_name, moving_image_name, max_workers):
+        """
+        Choose the threads and workers registering moving_image_name from the
+        headers of the fixed and moving images, see plan_threads, and report the
+        choice to master. Return the linear stage threads, SyN stage workers
+        and SyN stage threads, as strings for get_ants_args.
+        """
+        headers = [read_nifti_header(image_name)
+                   for image_name in (fixed_image_name, moving_image_name)]
+        voxels = None
+        if None not in headers:
+            # Both images are smoothed and resampled at every level, the larger one dominates
+            voxels = max(functools.reduce(lambda x, y: x * y, header["dims"], 1)
+                         for header in headers)
+        linear_threads, syn_workers, syn_threads = \
+            plan_threads(voxels, int(os.environ['ITK_THREADS_PER_WORKER']),
+                         max_workers, self.voxels_per_thread)
+        self.write_report({"kind":           "allocation",
+                           "image":          moving_image_name.split('/')[-1].split('.')[0],
+                           "voxels":         voxels,
+                           "spacing":        headers[1] and headers[1]["spacing"],
+                           "linear_threads": linear_threads,
+                           "syn_workers":    syn_workers,
+                           "syn_threads":    syn_threads})
+        return str(linear_threads), str(syn_workers), str(syn_threads)
+
+    def get_allocation_report(self):
+        """
+        Should only be called by master worker, once every image is registered.
+        Return the threads and workers chosen for each image by get_allocation.
+        """
+        allocation = {}
+        for report in self.read_reports("allocation"):
+            # Later reports of an image update the workers actually used
+            allocation.setdefault(report["image"], {}).update(
+                {key: value for key, value in report.items() if key not in ("kind", "image")})
+        return dict(sorted(allocation.items()))
+
+    def get_ants_args(self, fixed_image_name, moving_image_name, out_path,
+                      linear_total_threads, syn_number_of_workers, syn_total_threads):
+        """
+        Return the args of the linear and SyN stages for registering moving_image_name.
+        The linear stage always runs on a single worker. With a scratch directory,
+        its output is uncompressed if out_path is the scratch directory, and
+        compressed if out_path is shared with the other workers of the SyN stage.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        uncompressed = self.scratch_path is not None and out_path == self.scratch_path
+        linear_ants_args = {
+                            "fixed_image_name":   fixed_image_name,
+                            "moving_image_name":  moving_image_name,
+                            "out_path":           out_path,
+                            "name_wo_ext":        name_wo_ext,
+                            "number_of_workers":  '1',
+                            "total_threads":      linear_total_threads,
+                            "keep_transforms":    self.registration_cache is not None,
+                            "affine_init":        self.affine_init,
+                            "uncompressed":       uncompressed
+                           }
+        syn_ants_args    = {
+                            "fixed_image_name":   fixed_image_name,
+                            "out_path":           out_path,
+                            "name_wo_ext":        name_wo_ext,
+                            "number_of_workers":  syn_number_of_workers,
+                            "total_threads":      syn_total_threads,
+                            "keep_transforms":    self.registration_cache is not None
+                           }
+        if self.affine_init:
+            # SyN stage starts from the original moving image and the affine transform
+            syn_ants_args["moving_image_name"] = moving_image_name
+            syn_ants_args["initial_transform"] = '{}/{}Linear0GenericAffine.mat' \
+                                                 .format(out_path, name_wo_ext)
+        elif uncompressed:
+            # Uncompressed output of linear registration, see publish_registration
+            syn_ants_args["moving_image_name"] = out_path + '/' + name_wo_ext + 'LinearWarped.nii'
+        else:
+            # moving image for syn registration is output of linear registration
+            syn_ants_args["moving_image_name"] = out_path + '/' + name_wo_ext + 'LinearWarped.nii.gz'
+        return linear_ants_args, syn_ants_args
+
+    def get_env_for_independent_execution(self, tag, threads=None):
+        """
+        Return a copy of the environment in which an ants process runs alone,
+        without synchronizing with the other workers, using barrier and data
+        files of its own, named after tag, and threads threads (every thread of
+        the worker by default).
+        """
+        env = dict(os.environ)
+        if threads is not None:
+            env['ITK_THREADS_PER_WORKER'] = str(threads)
+        barrier_file_prefix = '{}/itkbarrier_{}_'.format(self.tmp_path, tag)
+        env['ITK_WORKER_NUMBER']       = '0'
+        env['ITK_NUMBER_OF_WORKERS']   = '1'
+        env['ITK_BARRIER_FILE_PREFIX'] = barrier_file_prefix
+        env['ITK_DATA_FILE_PREFIX']    = '{}/itkdata_{}_'.format(self.tmp_path, tag)
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = env['ITK_THREADS_PER_WORKER']
+        with open(barrier_file_prefix + '0','wb+') as barrier_file:
+            barrier_file.write(b'\0'*8) #unsigned long
+            barrier_file.close()
+        return env
+
+    def run_pipelined_master(self, fixed_image_name, moving_image_list, pending_images,
+                             out_path):
+        """
+        Should only be called by master worker.
+        Register the moving images one at a time with all workers cooperating on
+        the SyN stage, while the master uses the time of each SyN stage to run
+        the linear stage of the next image and the DICOM conversion and mosaic
+        of other images, on the threads it keeps for them, see get_side_threads.
+        moving_image_list holds NIFTI files. pending_images, if not None, yields
+        lists of NIFTI files as they become ready, such as volumes converted from
+        DICOM; they are registered as soon as they are yielded.
+        """
+        self.configure_env_for_multi_threaded_execution()
+        pipeline = StagePipeline(3)
+        syn_stages = []
+        pipeline.add('mosaic:fixed',
+                     lambda: self.make_fixed_mosaic(fixed_image_name, out_path))
+        for moving_image_name in moving_image_list:
+            self.add_registration_stages(pipeline, syn_stages, fixed_image_name,
+                                         moving_image_name, out_path)
+        if pending_images is not None:
+            pipeline.add('convert',
+                         lambda: [self.add_registration_stages(pipeline, syn_stages,
+                                                               fixed_image_name,
+                                                               moving_image_name, out_path)
+                                  for nii_file_list in pending_images
+                                  for moving_image_name in nii_file_list])
+        failed_images = set()
+        for stage, error in pipeline.run().items():
+            # Stages are named <stage>:<image>, report the first failed stage of each image
+            stage, image = stage.split(':', 1)
+            if image not in failed_images:
+                failed_images.add(image)
+                self.record_failure(image, stage, error)
+
+    def add_registration_stages(self, pipeline, syn_stages, fixed_image_name,
+                                moving_image_name, out_path):
+        """
+        Add the linear, SyN and mosaic stages of moving_image_name to pipeline.
+        syn_stages lists the SyN stages added so far; the linear stage runs at
+        most one image ahead of the SyN stage.
+        Stages completed by a previous run, according to the job manifest, are
+        not added, nor is anything if the registration is restored from the
+        registration cache.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        completed_stages = self.get_completed_stages(moving_image_name, out_path)
+        if 'thumbnail' in completed_stages:
+            return
+        if 'syn' not in completed_stages:
+            if self.registration_cache is not None and \
+               self.restore_cached_registration(fixed_image_name, moving_image_name, out_path):
+                return
+            linear_ants_args, syn_ants_args = self.get_master_ants_args(fixed_image_name,
+                                                                        moving_image_name,
+                                                                        out_path)
+            linear_threads = None
+            linear_after = syn_stages[-2:-1]
+            if syn_stages and self.get_side_threads() == 0:
+                # No spare cores, wait for the SyN stage of the previous image
+                linear_after = syn_stages[-1:]
+            elif syn_stages:
+                # Runs next to the SyN stage of the previous image
+                linear_threads = min(int(linear_ants_args["total_threads"]),
+                                     self.get_side_threads())
+                linear_ants_args = dict(linear_ants_args, total_threads=str(linear_threads))
+                self.write_report({"kind":           "allocation",
+                                   "image":          name_wo_ext,
+                                   "linear_threads": linear_threads})
+            if 'linear' not in completed_stages:
+                pipeline.add('linear:' + name_wo_ext,
+                             lambda: self.linear_ants_registration_command_wrapper(
+                                         linear_ants_args,
+                                         self.get_env_for_independent_execution(
+                                             'linear_' + name_wo_ext, linear_threads)),
+                             after=linear_after)
+            pipeline.add('syn:' + name_wo_ext,
+                         lambda: self.run_parallel_syn_ants_registration_master(syn_ants_args),
+                         depends_on=['linear:' + name_wo_ext],
+                         exclusive=True)
+            syn_stages.append('syn:' + name_wo_ext)
+        # With a scratch directory, the SyN stage wrote to the one of master
+        pipeline.add('mosaic:' + name_wo_ext,
+                     lambda: self.make_warped_mosaic(out_path, name_wo_ext, self.scratch_path),
+                     depends_on=['syn:' + name_wo_ext])
+        if self.registration_cache is not None and 'syn' not in completed_stages:
+            pipeline.add('cache:' + name_wo_ext,
+                         lambda: self.store_cached_registration(fixed_image_name,
+                                                                moving_image_name, out_path,
+                                                                self.scratch_path),
+                         depends_on=['mosaic:' + name_wo_ext])
+
+    def get_completed_stages(self, moving_image_name, out_path):
+        """
+        Return the set of stages of moving_image_name completed by a previous run,
+        according to the job manifest, whose outputs are still in out_path.
+        Nothing counts as completed if the moving image changed since.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        prefix = '{}/{}'.format(out_path, name_wo_ext)
+        stages = self.manifest.get(name_wo_ext)
+        if stages.get("source") != self.get_source_signature(moving_image_name):
+            return set()
+        completed_stages = set()
+        linear_output = 'LinearWarped.nii.gz'
+        if self.affine_init:
+            linear_output = 'Linear0GenericAffine.mat'
+        if stages.get("linear") and os.path.exists(prefix + linear_output):
+            completed_stages.add('linear')
+        if stages.get("syn") and os.path.exists(prefix + 'Warped.nii.gz'):
+            completed_stages.add('syn')
+            if stages.get("thumbnail") and os.path.exists(prefix + 'WarpedTiled.jpg'):
+                completed_stages.add('thumbnail')
+        if completed_stages:
+            print("PLUGIN DEBUG MSG: Resuming {}, already done: {}"
+                  .format(name_wo_ext, ', '.join(sorted(completed_stages))))
+            self.write_report({"kind": "resume", "image": name_wo_ext,
+                               "stages": sorted(completed_stages)})
+        return completed_stages
+
+    def get_source_signature(self, moving_image_name):
+        """
+        Return what identifies moving_image_name across runs in the job manifest.
+        Volumes converted from DICOM are converted again once tmp_path is removed,
+        so they are compared by content rather than by modification time.
+        """
+        if moving_image_name.startswith(self.tmp_path + '/'):
+            return hash_file(moving_image_name)
+        return get_file_signature(moving_image_name)
+
+    def get_fixed_signature(self, fixed_path):
+        """
+        Return what identifies the fixed image, a file or a DICOM directory, across
+        runs in the job manifest settings, so that a fixed image changed under the
+        same name does not keep the outputs registered to the old one. Return None
+        if fixed_path is not on this worker, as for slaves in network coordinator mode.
+        """
+        if os.path.isdir(fixed_path):
+            return {name: get_file_signature(fixed_path + '/' + name)
+                    for name in sorted(os.listdir(fixed_path))}
+        if os.path.isfile(fixed_path):
+            return get_file_signature(fixed_path)
+        return None
+
+    def get_resume_report(self):
+        """
+        Should only be called by master worker, once every image is registered.
+        Return the stages each image skipped because a previous run completed them.
+        """
+        return {report["image"]: report["stages"]
+                for report in sorted(self.read_reports("resume"),
+                                     key=lambda report: report["image"])}
+
+    def choose_schedule(self, schedule, moving_image_list):
+        """
+        Decide between registering images one at a time with all workers
+        cooperating on SyN (SCHEDULE_SYN) and handing whole images to free
+        workers (SCHEDULE_IMAGE).
+        Image level parallelism has no barrier overhead and also keeps
+        workers busy during the linear stages, so it is preferred as soon as
+        there is at least one image per worker.
+        """
+        NUMBER_OF_WORKERS = int(os.environ['NUMBER_OF_WORKERS'])
+        if schedule in (self.SCHEDULE_SYN, self.SCHEDULE_IMAGE):
+            return schedule
+        if NUMBER_OF_WORKERS > 1 and len(moving_image_list) >= NUMBER_OF_WORKERS:
+            return self.SCHEDULE_IMAGE
+        return self.SCHEDULE_SYN
+
+    def write_work_queue(self, fixed_image_name, moving_image_list, out_path, closed=True):
+        """
+        Should only be called by master worker.
+        Write the moving images to the 'work_queue' file in tmp_path, largest first
+        by number of voxels (see get_job_size, file sizes would put compressed
+        images last), so that the longest registrations start early and small
+        ones fill the gaps at the end of the batch.
+        If closed is False, workers keep waiting for images added with
+        append_to_work_queue until close_work_queue is called.
+        """
+        sizes = {job: self.get_job_size(job) for job in moving_image_list}
+        jobs = sorted(moving_image_list, key=sizes.get, reverse=True)
+        queue = {
+                 "fixed_image_name": fixed_image_name,
+                 "out_path":         out_path,
+                 "pending":          jobs,
+                 "running":          {},    # image -> {worker: start time}
+                 "done":             {},    # image -> worker, seconds and size
+                 "sizes":            sizes,
+                 "speculated":       {},    # image -> duplicate launched, see choose_straggler
+                 "closed":           closed
+                }
+        with self.locked(self.work_queue_file_lock):
+            with open(self.work_queue_file_path,'w') as work_queue_file:
+                json.dump(queue, work_queue_file)
+                work_queue_file.close()
+
+    def append_to_work_queue(self, moving_image_list=(), close=False):
+        """
+        Should only be called by master worker.
+        Add moving images to an open work queue, keeping it sorted largest first.
+        If close is set, no more images will be added.
+        """
+        with self.locked(self.work_queue_file_lock):
+            with open(self.work_queue_file_path,'r+') as work_queue_file:
+                queue = json.load(work_queue_file)
+                queue["sizes"].update({job: self.get_job_size(job) for job in moving_image_list})
+                queue["pending"] = sorted(queue["pending"] + list(moving_image_list),
+                                          key=queue["sizes"].get, reverse=True)
+                queue["closed"] = queue["closed"] or close
+                work_queue_file.seek(0)
+                json.dump(queue, work_queue_file)
+                work_queue_file.truncate()
+                work_queue_file.close()
+
+    def close_work_queue(self):
+        self.append_to_work_queue(close=True)
+
+    @contextmanager
+    def work_queue(self):
+        """
+        Load the work queue for the body of the with statement, holding its
+        lock, and write it back afterwards.
+        """
+        with self.locked(self.work_queue_file_lock):
+            with open(self.work_queue_file_path,'r+') as work_queue_file:
+                queue = json.load(work_queue_file)
+                yield queue
+                work_queue_file.seek(0)
+                json.dump(queue, work_queue_file)
+                work_queue_file.truncate()
+                work_queue_file.close()
+
+    def get_job_size(self, moving_image_name):
+        """
+        Return the number of voxels of moving_image_name, or its size in bytes
+        if its header cannot be read, for the runtime model of choose_straggler.
+        """
+        return get_image_voxels([moving_image_name]) or os.path.getsize(moving_image_name)
+
+    def update_work_queue(self, finished_job=False, worker_num=None):
+        """
+        Atomically claim the next moving image from the work queue for worker
+        worker_num (the current worker by default). If no image is pending,
+        claim a duplicate of a straggler instead, see choose_straggler.
+        If finished_job is set, also leave the previously claimed image.
+        Return (fixed_image_name, moving_image_name, out_path, closed, running),
+        moving_image_name is None when no image is available; closed tells whether
+        more may still come, and running whether a running image may still need
+        a duplicate.
+        """
+        if self.coordinator is not None:
+            return tuple(self.coordinator.request('update_work_queue',
+                                                  finished_job=finished_job,
+                                                  worker=self.worker_num)["job"])
+        worker = str(self.worker_num if worker_num is None else worker_num)
+        with self.work_queue() as queue:
+            now = time.time()
+            if finished_job:
+                for job, workers in list(queue["running"].items()):
+                    workers.pop(worker, None)
+                    if not workers:
+                        del queue["running"][job]
+            moving_image_name = None
+            if len(queue["pending"]) > 0:
+                moving_image_name = queue["pending"].pop(0)
+                queue["running"][moving_image_name] = {worker: now}
+            elif self.speculation_factor > 0:
+                moving_image_name = self.choose_straggler(queue, now)
+                if moving_image_name is not None:
+                    queue["running"][moving_image_name][worker] = now
+                    queue["speculated"][moving_image_name]["duplicate"] = int(worker)
+            running = self.speculation_factor > 0 and \
+                      any(len(workers) == 1 and job not in queue["done"]
+                          for job, workers in queue["running"].items())
+        return (queue["fixed_image_name"], moving_image_name, queue["out_path"],
+                queue["closed"], running)
+
+    def choose_straggler(self, queue, now):
+        """
+        Return the running image of queue that most exceeds its expected runtime,
+        if by more than speculation_factor times, and has no duplicate yet, or
+        None. Images run less than SPECULATION_MIN_SECONDS seconds are left alone,
+        and so is everything until SPECULATION_MIN_SAMPLES images are done.
+        The runtime of an image is expected from images of similar size, see
+        estimate_runtime. Records the choice in queue["speculated"].
+        """
+        completed = [(done["size"], done["seconds"]) for done in queue["done"].values()]
+        if len(completed) < self.SPECULATION_MIN_SAMPLES:
+            return None
+        straggler, straggler_ratio = None, self.speculation_factor
+        for job, workers in queue["running"].items():
+            if job in queue["done"] or len(workers) > 1:
+                continue
+            elapsed = now - min(workers.values())
+            expected = estimate_runtime(completed, queue["sizes"][job])
+            if elapsed >= self.SPECULATION_MIN_SECONDS and elapsed / expected > straggler_ratio:
+                straggler, straggler_ratio = job, elapsed / expected
+                speculated = {"worker":   int(next(iter(workers))),
+                              "elapsed":  round(elapsed, 1),
+                              "expected": round(expected, 1)}
+        if straggler is not None:
+            print("PLUGIN DEBUG MSG: {} runs {:.0f}s, {:.1f} times longer than expected, "
+                  "starting a duplicate".format(straggler, speculated["elapsed"],
+                                                straggler_ratio))
+            queue["speculated"][straggler] = speculated
+        return straggler
+
+    def claim_job(self, moving_image_name):
+        """
+        Called by a worker that completed the SyN stage of moving_image_name,
+        before publishing its outputs. Return True if it is the first worker to
+        do so, False if a duplicate registration finished first.
+        """
+        if self.coordinator is not None:
+            return self.coordinator.request('claim_job', moving_image_name=moving_image_name,
+                                            worker=self.worker_num)["won"]
+        return self.claim_job_for_worker(moving_image_name, self.worker_num)
+
+    def claim_job_for_worker(self, moving_image_name, worker_num):
+        worker = str(worker_num)
+        with self.work_queue() as queue:
+            done = queue["done"].get(moving_image_name)
+            if done is not None:
+                return done["worker"] == worker_num
+            now = time.time()
+            start = queue["running"].get(moving_image_name, {}).get(worker, now)
+            queue["done"][moving_image_name] = {"worker":  worker_num,
+                                                "seconds": now - start,
+                                                "size":    queue["sizes"].get(moving_image_name, 0)}
+            if moving_image_name in queue["speculated"]:
+                queue["speculated"][moving_image_name]["winner"] = worker_num
+        return True
+
+    def get_job_state(self, moving_image_name):
+        """
+        Return the worker that completed moving_image_name (None if none did yet)
+        and the workers registering it.
+        """
+        if self.coordinator is not None:
+            reply = self.coordinator.request('job_state', moving_image_name=moving_image_name)
+            return reply["winner"], reply["workers"]
+        with self.work_queue() as queue:
+            done = queue["done"].get(moving_image_name)
+            workers = [int(worker) for worker in queue["running"].get(moving_image_name, {})]
+        return (done["worker"] if done is not None else None), workers
+
+    def get_speculation_report(self):
+        """
+        Should only be called by master worker, once every image is registered.
+        Return the images a duplicate registration was started for, and which
+        worker completed them first.
+        """
+        with self.work_queue() as queue:
+            return {job.split('/')[-1].split('.')[0]: speculated
+                    for job, speculated in queue["speculated"].items()
+                    if "duplicate" in speculated}
+
+    def work_queue_is_done(self):
+        """
+        Return True when every image in the work queue has been registered
+        and no more images will be added, duplicates included.
+        """
+        with self.locked(self.work_queue_file_lock):
+            with open(self.work_queue_file_path,'r') as work_queue_file:
+                queue = json.load(work_queue_file)
+                work_queue_file.close()
+        return queue["closed"] and len(queue["pending"]) == 0 and len(queue["running"]) == 0
+
+    def configure_env_for_independent_execution(self):
+        """
+        Configure ITK so that this worker runs ants on its own, without
+        synchronizing with the other workers. Each worker gets its own barrier
+        and data files so concurrent registrations do not interfere.
+        Return the previous values so that they can be restored.
+        """
+        worker_num = os.environ['ITK_WORKER_NUMBER']
+        keys = ['ITK_WORKER_NUMBER', 'ITK_NUMBER_OF_WORKERS',
+                'ITK_BARRIER_FILE_PREFIX', 'ITK_DATA_FILE_PREFIX']
+        saved_env = {key: os.environ.get(key) for key in keys}
+        barrier_file_prefix = '{}/itkbarrier_w{}_'.format(self.tmp_path, worker_num)
+        os.environ['ITK_WORKER_NUMBER']       = '0'
+        os.environ['ITK_NUMBER_OF_WORKERS']   = '1'
+        os.environ['ITK_BARRIER_FILE_PREFIX'] = barrier_file_prefix
+        os.environ['ITK_DATA_FILE_PREFIX']    = '{}/itkdata_w{}_'.format(self.tmp_path, worker_num)
+        with open(barrier_file_prefix + '0','wb+') as barrier_file:
+            barrier_file.write(b'\0'*8) #unsigned long
+            barrier_file.close()
+        return saved_env
+
+    def restore_env(self, saved_env):
+        for key, value in saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+    def run_ants_registration_single_worker(self, fixed_image_name, moving_image_name, out_path,
+                                            job=None):
+        """
+        Register one moving image using only the current worker.
+        Both the linear and the SyN stages use up to all threads of this worker,
+        and write to its scratch directory if it has one.
+        Stages completed by a previous run, according to the job manifest, are skipped.
+        job is the name of the image in the work queue when another worker may
+        register it too, see choose_straggler. The stages of an image not started
+        by a previous run then write to a directory of this worker, and the outputs
+        are only moved to out_path if this worker completes the SyN stage first;
+        return False if it did not.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        completed_stages = self.get_completed_stages(moving_image_name, out_path)
+        if 'thumbnail' in completed_stages:
+            return True
+        stage_path = self.scratch_path or out_path
+        if job is not None and self.scratch_path is None and not completed_stages:
+            stage_path = '{}/stage_w{}'.format(self.tmp_path, self.worker_num)
+            os.makedirs(stage_path, exist_ok=True)
+        if 'syn' not in completed_stages:
+            if self.registration_cache is not None and \
+               self.restore_cached_registration(fixed_image_name, moving_image_name, out_path):
+                return True
+            linear_ants_args, syn_ants_args = self.get_ants_args(fixed_image_name,
+                                                                 moving_image_name,
+                                                                 stage_path,
+                                                                 *self.get_allocation(
+                                                                     fixed_image_name,
+                                                                     moving_image_name, 1))
+            if 'linear' not in completed_stages:
+                self.linear_ants_registration_command_wrapper(linear_ants_args)
+            self.syn_ants_registration_command_wrapper(syn_ants_args)
+            if job is not None and not self.claim_job(job):
+                print("PLUGIN DEBUG MSG: {} was registered by another worker first"
+                      .format(name_wo_ext))
+                if stage_path != out_path:
+                    self.remove_stage_files(stage_path, name_wo_ext)
+                return False
+            self.manifest.mark(name_wo_ext, syn=True)
+        # Next image can start while the mosaic is made
+        self.run_in_background(lambda: self.finish_ants_registration_single_worker(
+                                           fixed_image_name, moving_image_name, out_path,
+                                           name_wo_ext, 'syn' not in completed_stages,
+                                           stage_path))
+        return True
+
+    def remove_stage_files(self, stage_path, name_wo_ext):
+        """
+        Remove whatever the stages of name_wo_ext left in stage_path.
+        """
+        for suffix in ['Warped.nii', 'LinearWarped.nii'] + self.STAGE_OUTPUTS:
+            try:
+                os.remove('{}/{}{}'.format(stage_path, name_wo_ext, suffix))
+            except FileNotFoundError:
+                pass
+
+    def finish_ants_registration_single_worker(self, fixed_image_name, moving_image_name,
+                                               out_path, name_wo_ext, store=True,
+                                               stage_path=None):
+        """
+        Make the mosaic of a registered image and, if store is True, store the
+        results in the registration cache. stage_path is where the stages wrote
+        their outputs, out_path by default.
+        """
+        try:
+            self.make_warped_mosaic(out_path, name_wo_ext, stage_path)
+            if self.registration_cache is not None and store:
+                self.store_cached_registration(fixed_image_name, moving_image_name, out_path,
+                                               self.scratch_path and stage_path)
+        except Exception as e:
+            self.record_failure(name_wo_ext, 'mosaic', e)
+
+    def run_work_queue_worker(self):
+        """
+        Called by every worker (master included) in image scheduling mode.
+        Keep claiming moving images from the work queue and registering them
+        until the queue is empty.
+        """
+        saved_env = self.configure_env_for_independent_execution()
+        fixed_image_name, moving_image_name, out_path, closed, running = self.update_work_queue()
+        while moving_image_name is not None or not closed or running:
+            if moving_image_name is None:
+                # Queue is still being filled, e.g. by DICOM conversion, or a running
+                # image may need a duplicate; the whole wait is a single stage of
+                # the timeline
+                with self.stage_timer('wait_for_images') as record:
+                    while moving_image_name is None and (not closed or running):
+                        # Duplicates are only needed after SPECULATION_MIN_SECONDS
+                        time.sleep(0.2 if not closed else self.SPECULATION_POLL_INTERVAL)
+                        fixed_image_name, moving_image_name, out_path, closed, running = \
+                            self.update_work_queue()
+                    record["wait"] = time.time() - record["start"]
+                continue
+            print("PLUGIN DEBUG MSG: Worker #{} registering {} to {} ... "
+                  .format(saved_env['ITK_WORKER_NUMBER'], moving_image_name, fixed_image_name))
+            job = moving_image_name if self.speculation_factor > 0 else None
+            try:
+                with self.cancel_when_registered_elsewhere(job):
+                    if self.coordinator is not None:
+                        self.run_staged_registration(fixed_image_name, moving_image_name,
+                                                     out_path, job)
+                    else:
+                        self.run_ants_registration_single_worker(fixed_image_name,
+                                                                 moving_image_name,
+                                                                 out_path, job)
+            except Exception as e:
+                # One bad image does not stop the batch, nor does a duplicate failing
+                # while the other registration of the image may still succeed
+                winner, workers = self.get_job_state(job) if job else (None, [])
+                if winner is None and workers in ([], [self.worker_num]):
+                    self.record_failure(moving_image_name.split('/')[-1].split('.')[0],
+                                        getattr(e, 'stage', 'registration'), e)
+            fixed_image_name, moving_image_name, out_path, closed, running = \
+                self.update_work_queue(True)
+        self.wait_for_background_tasks()
+        self.restore_env(saved_env)
+
+    @contextmanager
+    def cancel_when_registered_elsewhere(self, job):
+        """
+        While the body of the with statement registers job, an image of the work
+        queue, check every SPECULATION_POLL_INTERVAL seconds whether another worker
+        completed it, and if so kill the commands of this worker for it.
+        Does nothing if job is None.
+        """
+        if job is None:
+            yield
+            return
+        log_name = '{}.w{}'.format(job.split('/')[-1].split('.')[0], self.worker_num)
+        done = threading.Event()
+        def watch():
+            while not done.wait(self.SPECULATION_POLL_INTERVAL):
+                try:
+                    winner, _ = self.get_job_state(job)
+                except (OSError, CoordinatorError) as e:
+                    print("PLUGIN DEBUG MSG: Could not get state of {}: {}".format(job, e))
+                    continue
+                if winner is not None and winner != self.worker_num:
+                    print("PLUGIN DEBUG MSG: Worker #{} registered {} first, cancelling"
+                          .format(winner, job))
+                    self.command_engine.cancel(log_name)
+                    return
+        watcher = threading.Thread(target=watch, daemon=True)
+        watcher.start()
+        try:
+            yield
+        finally:
+            done.set()
+            watcher.join()
+            self.command_engine.uncancel(log_name)
+
+    def run_staged_registration(self, fixed_image_name, moving_image_name, out_path, job=None):
+        """
+        Called by slaves in network coordinator mode, instead of
+        run_ants_registration_single_worker, for an image claimed from the work
+        queue. Fetch the images from the coordinator, register them in the local
+        scratch directory and send the outputs, logs included, back to master's
+        out_path. Outputs are not sent if another worker registered the image
+        first, see run_ants_registration_single_worker, nor if registration
+        failed, but the logs always are.
+        """
+        stages = self.coordinator.request('completed_stages',
+                                          moving_image_name=moving_image_name)["stages"]
+        if 'thumbnail' in stages:
+            return
+        local_out_path = self.tmp_path + '/out'
+        local_moving_image_name = self.stage_in(moving_image_name)
+        try:
+            if not self.run_ants_registration_single_worker(self.stage_in(fixed_image_name),
+                                                            local_moving_image_name,
+                                                            local_out_path, job):
+                return
+            # The mosaic must be done before its file is sent
+            self.wait_for_background_tasks()
+            self.stage_out(local_out_path)
+        except CommandError as e:
+            if e.log_file_path.startswith(local_out_path + '/'):
+                e.move_log(out_path + e.log_file_path[len(local_out_path):])
+            raise
+        finally:
+            os.remove(local_moving_image_name)
+            del self.staged_files[moving_image_name]
+            # Logs of failed images too, local_out_path goes with tmp_path when exiting
+            self.stage_out(local_out_path, local_out_path + '/logs')
+        self.coordinator.request('image_done', moving_image_name=moving_image_name)
+
+    def stage_in(self, file_path):
+        """
+        Should only be called by slaves in network coordinator mode.
+        Return the local copy of file_path, fetching it from the coordinator
+        the first time. The file name is kept, as outputs are named after it.
+        """
+        if file_path not in self.staged_files:
+            local_dir_path = '{}/in/{}'.format(
+                self.tmp_path, hashlib.sha256(os.path.dirname(file_path).encode()).hexdigest()[:16])
+            os.makedirs(local_dir_path, exist_ok=True)
+            local_file_path = local_dir_path + '/' + os.path.basename(file_path)
+            self.coordinator.request('get_file', path=file_path, output_path=local_file_path)
+            self.staged_files[file_path] = local_file_path
+        return self.staged_files[file_path]
+
+    def stage_out(self, local_out_path, local_dir_path=None):
+        """
+        Should only be called by slaves in network coordinator mode.
+        Send every file in local_dir_path, by default every file in local_out_path,
+        to the same place in the output directory of master, removing the local copies.
+        """
+        for dir_path, _, file_names in os.walk(local_dir_path or local_out_path):
+            for file_name in file_names:
+                local_file_path = os.path.join(dir_path, file_name)
+                self.coordinator.request('put_file', file_path=local_file_path,
+                                         path=os.path.relpath(local_file_path, local_out_path))
+                os.remove(local_file_path)
+
+    def run_work_queue_master(self, fixed_image_name, moving_image_list, pending_images,
+                              out_path):
+        """
+        Should only be called by master worker.
+        Distribute whole moving images among all workers and wait until every
+        image has been registered. Lists of NIFTI files yielded by pending_images,
+        if not None, are queued in the background as soon as they are ready.
+        """
+        self.write_work_queue(fixed_image_name, moving_image_list, out_path,
+                              closed=pending_images is None)
+        self.write_state(self.QUEUE)
+        if pending_images is not None:
+            conversion_thread = threading.Thread(target=self.queue_pending_images,
+                                                 args=(pending_images,),
+                                                 daemon=True)
+            conversion_thread.start()
+        self.run_work_queue_worker()
+        print("PLUGIN DEBUG MSG: Waiting for slaves to finish their images ... ")
+        with self.stage_timer('wait_for_slaves') as record:
+            if self.channel_condition is None:
+                while not self.work_queue_is_done():
+                    time.sleep(1)
+            else:
+                # Connected slaves report when they are done. The timeout covers
+                # slaves that use the file protocol.
+                with self.channel_condition:
+                    while not self.work_queue_is_done():
+                        self.channel_condition.wait(1)
+            record["wait"] = time.time() - record["start"]
+        self.write_state(self.IDLE)
+
+    def queue_pending_images(self, pending_images):
+        """
+        Should only be called by master worker, in a background thread.
+        Add the lists of NIFTI files yielded by pending_images to the work
+        queue, and close it once pending_images is exhausted.
+        """
+        try:
+            for nii_file_list in pending_images:
+                self.append_to_work_queue(nii_file_list)
+        finally:
+            self.close_work_queue()
+
+    def get_registration_cache_key(self, fixed_image_name, moving_image_name):
+        """
+        Return the registration cache key of moving_image_name registered to
+        fixed_image_name with the current parameters.
+        """
+        params = {
+                  "version":                   self.VERSION,
+                  "ants_registration_command": self.ants_registration_command,
+                  "stages":                    ['-t a', '-t so'],
+                  "affine_init":               self.affine_init
+                 }
+        return self.registration_cache.get_key([fixed_image_name, moving_image_name], params)
+
+    @timed_stage('cache_lookup', image_arg=1)
+    def restore_cached_registration(self, fixed_image_name, moving_image_name, out_path):
+        """
+        If the registration of moving_image_name is in the registration cache, put
+        its outputs in out_path and return True. Return False otherwise.
+        Registration cache must be enabled.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        key = self.get_registration_cache_key(fixed_image_name, moving_image_name)
+        hit = self.registration_cache.lookup(key) is not None and \
+              self.registration_cache.restore(key, {name: '{}/{}{}'.format(out_path, name_wo_ext, name)
+                                                    for name in self.CACHED_OUTPUTS})
+        print("PLUGIN DEBUG MSG: Registration cache {} for {}"
+              .format('hit' if hit else 'miss', moving_image_name))
+        self.record_cache_result(moving_image_name, hit)
+        if hit:
+            self.manifest.mark(name_wo_ext, linear=True, syn=True, thumbnail=True,
+                               source=self.get_source_signature(moving_image_name))
+        return hit
+
+    @timed_stage('cache_store', image_arg=1)
+    def store_cached_registration(self, fixed_image_name, moving_image_name, out_path,
+                                  stage_path=None):
+        """
+        Store the outputs and transforms of the registration of moving_image_name
+        in the registration cache, then remove the transforms from stage_path,
+        where the stages wrote them (out_path by default). Transforms not in
+        stage_path are taken from out_path, like those of the linear stage
+        with -p syn, which every worker reads.
+        """
+        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
+        key = self.get_registration_cache_key(fixed_image_name, moving_image_name)
+        files = {name: '{}/{}{}'.format(out_path, name_wo_ext, name)
+                 for name in self.CACHED_OUTPUTS}
+        for name in self.CACHED_TRANSFORMS:
+            files[name] = '{}/{}{}'.format(stage_path or out_path, name_wo_ext, name)
+            if not os.path.exists(files[name]):
+                files[name] = '{}/{}{}'.format(out_path, name_wo_ext, name)
+        self.registration_cache.store(key, files)
+        for name in self.CACHED_TRANSFORMS:
+            try:
+                os.remove(files[name])
+            except FileNotFoundError:
+                pass
+
+    def get_fixed_image_cache_key(self, file_path_list, artifact, names=()):
+        """
+        Return the registration cache key of artifact, 'nifti' or 'mosaic',
+        prepared from the fixed image files in file_path_list.
+        """
+        return self.registration_cache.get_key(file_path_list,
+                                               {"version":  self.VERSION,
+                                                "artifact": 'fixed_image_' + artifact,
+                                                "names":    list(names)})
+
+    @timed_stage('fixed_image')
+    def convert_fixed_image(self, dcm_input_dir_path):
+        """
+        Convert the fixed DICOM directory and return the path of the volume used
+        as fixed image, the first one if there are several. The volume is restored
+        from the registration cache, if enabled, when a directory with the same
+        content was converted before.
+        """
+        nii_dir_path = self.tmp_path + '/fixed_image_nii'
+        key = None
+        if self.registration_cache is not None:
+            names = sorted(os.path.relpath(dir_path + '/' + name, dcm_input_dir_path)
+                           for dir_path, _, file_names in os.walk(dcm_input_dir_path)
+                           for name in file_names)
+            key = self.get_fixed_image_cache_key([dcm_input_dir_path + '/' + name
+                                                  for name in names], 'nifti', names)
+            entry_path = self.registration_cache.lookup(key)
+            if entry_path is not None:
+                cached_names = os.listdir(entry_path)
+                os.makedirs(nii_dir_path, exist_ok=True)
+                if len(cached_names) == 1 and self.registration_cache.restore(
+                        key, {cached_names[0]: nii_dir_path + '/' + cached_names[0]}):
+                    print("PLUGIN DEBUG MSG: Fixed image restored from registration cache")
+                    self.record_fixed_cache_result('nifti', True)
+                    return nii_dir_path + '/' + cached_names[0]
+            self.record_fixed_cache_result('nifti', False)
+        nii_file_list = self.dcm_to_nii_wrapper('fixed_image', dcm_input_dir_path)
+        if len(nii_file_list) == 0:
+            self.error("Could not convert the fixed image to NIFTI.")
+        if len(nii_file_list) > 1:
+            print("PLUGIN DEBUG MSG: Fixed image was converted to {} volumes, using {}."
+                  .format(len(nii_file_list), nii_file_list[0]))
+        if key is not None:
+            self.registration_cache.store(key, {nii_file_list[0].split('/')[-1]:
+                                                nii_file_list[0]})
+        return nii_file_list[0]
+
+    def make_fixed_mosaic(self, fixed_image_name, out_path):
+        """
+        Make FixedTiled.jpg in out_path, or restore it from the registration
+        cache, if enabled, when it was made for the same fixed image before.
+        """
+        out_file_path = '{}/FixedTiled.jpg'.format(out_path)
+        if self.registration_cache is not None:
+            key = self.get_fixed_image_cache_key([fixed_image_name], 'mosaic')
+            hit = self.registration_cache.lookup(key) is not None and \
+                  self.registration_cache.restore(key, {'FixedTiled.jpg': out_file_path})
+            self.record_fixed_cache_result('mosaic', hit)
+            if hit:
+                return
+        self.make_tiled_mosaic_jpeg_wrapper(fixed_image_name, out_file_path,
+                                            self.scratch_path or out_path)
+        if self.registration_cache is not None:
+            self.registration_cache.store(key, {'FixedTiled.jpg': out_file_path})
+
+    def write_report(self, report):
+        """
+        Append report, a JSON serializable dict with a "kind" key, to the
+        'report_w<worker>' file in tmp_path, read back by master with read_reports.
+        """
+        if self.coordinator is not None:
+            self.coordinator.request('report', report=report)
+            return
+        with open('{}/report_w{}'.format(self.tmp_path, self.worker_num),'a') as report_file:
+            report_file.write(json.dumps(report) + '\n')
+            report_file.close()
 
-    def define_parameters(self):
+    def read_reports(self, kind):
         """
-        -f filename for fixed image. All other files in the input 
-        directory will be interpreted as moving images.
+        Should only be called by master worker, once every image is registered.
+        Return the reports of the given kind written by all workers.
+        """
+        reports = []
+        for name in os.listdir(self.tmp_path):
+            if not name.startswith('report_w'):
+                continue
+            with open(self.tmp_path + '/' + name,'r') as report_file:
+                reports += [report for report in map(json.loads, report_file)
+                            if report["kind"] == kind]
+                report_file.close()
+        return reports
 
-        -s set "speed"
-           set to fast to run antsRegistrationSyNQuick.sh
-           set to slow to run antsRegistrationSyN.sh
+    def record_cache_result(self, moving_image_name, hit):
+        self.write_report({"kind": "cache", "image": moving_image_name, "hit": hit})
 
-        Define more parameters here as needed.
+    def record_fixed_cache_result(self, artifact, hit):
+        self.write_report({"kind": "fixed_cache", "artifact": artifact, "hit": hit})
+
+    def get_cache_report(self):
         """
-        self.add_argument('-f', dest='fixed', type=str, optional=False,
-                          help='The filename for the fixed image.')
-        self.add_argument('-s', dest='speed', type=str, optional=True, 
-                          default='antsRegistrationSyNQuick.sh',
-                          help='Set to "fast" or "slow" depending on speed and quality desired.')
+        Should only be called by master worker, once every image is registered.
+        Return registration cache hits and misses of all workers.
+        """
+        report = {"hits": 0, "misses": 0, "cached_images": [], "fixed_image": {}}
+        for result in self.read_reports("cache"):
+            if result["hit"]:
+                report["hits"] += 1
+                report["cached_images"].append(result["image"])
+            else:
+                report["misses"] += 1
+        for result in self.read_reports("fixed_cache"):
+            report["fixed_image"][result["artifact"]] = 'hit' if result["hit"] else 'miss'
+        return report
 
-    def get_worker_number(self):
+    def record_failure(self, image, stage, error):
         """
-        Get the next available worker number.
-        worker numbers range from 0 to NUMBER_OF_WORKERS-1.
-        Create file 'worker_num_sync' in tmp_path, which is used
-        to synchronize worker number assignment among available workeres.
-        Return the worker number.
+        Report that stage failed for image, which is then left out of the batch.
         """
-        NUMBER_OF_WORKERS = int(os.environ['NUMBER_OF_WORKERS'])
-        worker_num = 0
-        with self.worker_num_file_lock.acquire():
-            try:
-                with open(self.worker_num_file_path,'x') as worker_num_file:
-                    # Current worker is assigned 0, next worker is assigned 1.
-                    worker_num_file.write('1') 
-                    worker_num_file.close()
-                    worker_num = 0
-                    print("PLUGIN DEBUG MSG: {} not found. Assuming that I'm first, \
-                           so I'm assigning myself #0 and declaring \
-                           my self as master.".format(self.worker_num_file_path))
-            except FileExistsError:
-                with open(self.worker_num_file_path,'r+') as worker_num_file:
-                    # Read worker number and overwrite with next worker number
-                    worker_num = int(worker_num_file.read().strip())
-                    worker_num_file.seek(0)
-                    worker_num_file.write(str(worker_num + 1))
-                    worker_num_file.truncate()
-                    worker_num_file.close()
-        # Check that worker_num is less than number of workeres
-        if worker_num >= NUMBER_OF_WORKERS:
-            raise ValueError('PLUGIN ERROR MSG: Invalid worker number assigned.\
-                              Check worker_num_sync in shared directory.')
-        # Wait for all workeres to get their worker number
-        last_worker_num = worker_num
-        start_time = time.time()
-        while last_worker_num < NUMBER_OF_WORKERS:
-            with open(self.worker_num_file_path,'r') as worker_num_file:
-                last_worker_num = int(worker_num_file.read().strip())
-                worker_num_file.close()
-            time.sleep(1)
-            print("PLUGIN DEBUG MSG: waiting for every one to get proces number. I am #{}, \
-                   next worker will be assigned #{}".format(worker_num,last_worker_num))
-            if (time.time() - start_time) > 60:
-                raise RuntimeError('PLUGIN ERROR MSG: Timed out waiting \
-                                    for other instances to get worker number.')
-        print('PLUGIN ERROR MSG: Assigned worker Number {}.'.format(worker_num))
-        return worker_num
+        print("PLUGIN ERROR MSG: {} failed for {}: {}".format(stage, image, error))
+        self.write_report({"kind": "failure", "image": image, "stage": stage,
+                           "error": str(error)})
 
-    def exit_worker(self):
+    def get_failure_report(self):
         """
-        Exit the current worker. Decrement the worker_num_sync file.
-        If the worker is the last to leave, then remove tmp directory.
+        Should only be called by master worker, once every image is registered.
+        Return the failures of all workers, one per image and stage.
         """
-        print("PLUGIN DEBUG MSG: exiting ... ")
-        with self.worker_num_file_lock.acquire():
-            with open(self.worker_num_file_path,'r+') as worker_num_file:
-                # Read worker number and overwrite with decremented worker number
-                worker_num = int(worker_num_file.read().strip())
-                worker_num_file.seek(0)
-                worker_num_file.write(str(worker_num - 1))
-                worker_num_file.truncate()
-                worker_num_file.close()
-        if worker_num == 1:
-            subprocess.run(['rm','-rf',self.tmp_path])
-        sys.exit()
+        failures = {}
+        for failure in self.read_reports("failure"):
+            failures[(failure["image"], failure["stage"])] = failure
+        return [{"image": image, "stage": stage, "error": failure["error"]}
+                for (image, stage), failure in sorted(failures.items())]
 
-    def linear_ants_registration_command_wrapper(self,args):
+    def make_warped_mosaic(self, out_path, name_wo_ext, stage_path=None):
         """
-        Run ants registration command (Rigid and Affine stages only).
-        Output will be named <name_wo_ext>Warped.nii.gz
-      
-        Prerequisites:
-         * args.keys() = [fixed_image_name,moving_image_name,out_path,name_wo_ext,total_threads]
-         * be master worker
+        Make <name_wo_ext>WarpedTiled.jpg out of the registered image.
+        If the stages wrote to another directory, stage_path, the mosaic is made
+        there and moved to out_path along with the registered image, which is
+        compressed first with a scratch directory, see publish_registration.
         """
-        print("PLUGIN DEBUG MSG: Starting linear ants registration stages ... ")
-        os.environ['ITK_NUMBER_OF_WORKERS'] = args["number_of_workers"]
-        # Ants Registration Call 
-        self.run_bash_command_wrapper(self.ants_registration_command +
-                                      ' -d 3 -f {} -m {} -o {}/{} -n {} -t a'
-                                      .format(args["fixed_image_name"],
-                                              args["moving_image_name"],
-                                              args["out_path"],
-                                              args["name_wo_ext"],
-                                              args["total_threads"]))
-        # Remove extra outputs
-        files_to_be_removed = [args["out_path"] + '/' + args["name_wo_ext"] + 'InverseWarped.nii.gz',
-                               args["out_path"] + '/' + args["name_wo_ext"] + '0GenericAffine.mat']
-        for filename in files_to_be_removed:
+        stage_path = stage_path or out_path
+        if self.scratch_path is None and stage_path == out_path:
+            self.make_tiled_mosaic_jpeg_wrapper('{}/{}Warped.nii.gz'.format(out_path, name_wo_ext),
+                                                '{}/{}WarpedTiled.jpg'.format(out_path, name_wo_ext),
+                                                out_path)
+        else:
+            prefix = '{}/{}'.format(stage_path, name_wo_ext)
             try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+                self.make_tiled_mosaic_jpeg_wrapper(prefix + ('Warped.nii' if self.scratch_path
+                                                              else 'Warped.nii.gz'),
+                                                    prefix + 'WarpedTiled.jpg',
+                                                    self.scratch_path or stage_path)
+                publish_file(prefix + 'WarpedTiled.jpg',
+                             '{}/{}WarpedTiled.jpg'.format(out_path, name_wo_ext))
+            finally:
+                self.publish_registration(stage_path, out_path, name_wo_ext)
+        self.manifest.mark(name_wo_ext, thumbnail=True)
 
-    def syn_ants_registration_command_wrapper(self,args):
+    def publish_registration(self, stage_path, out_path, name_wo_ext):
         """
-        Run ants registration command (SyN stage only).
-        Output will be named <name_wo_ext>Warped.nii.gz
+        Should be called once the SyN stage of name_wo_ext is done, if it wrote
+        to stage_path rather than out_path. Without a scratch directory, move the
+        files of name_wo_ext in stage_path to out_path, as they are.
+        With a scratch directory, compress the uncompressed images the stages wrote
+        into <name_wo_ext>Warped.nii.gz, and LinearWarped.nii.gz if keep_intermediate
+        is set, in out_path, then remove the uncompressed images.
+        """
+        if self.scratch_path is None:
+            for suffix in self.STAGE_OUTPUTS if stage_path != out_path else []:
+                if os.path.exists('{}/{}{}'.format(stage_path, name_wo_ext, suffix)):
+                    publish_file('{}/{}{}'.format(stage_path, name_wo_ext, suffix),
+                                 '{}/{}{}'.format(out_path, name_wo_ext, suffix))
+            return
+        prefix = '{}/{}'.format(stage_path, name_wo_ext)
+        if self.keep_intermediate and os.path.exists(prefix + 'LinearWarped.nii'):
+            self.compress_output(prefix + 'LinearWarped.nii',
+                                 '{}/{}LinearWarped.nii.gz'.format(out_path, name_wo_ext))
+        try:
+            os.remove(prefix + 'LinearWarped.nii')
+        except FileNotFoundError:
+            pass
+        self.compress_output(prefix + 'Warped.nii',
+                             '{}/{}Warped.nii.gz'.format(out_path, name_wo_ext))
 
-        Prerequisites for slave worker:
-         * args.keys() = []
-        Prerequisites for master worker:
-         * args.keys() = [fixed_image_name,moving_image_name,out_path,name_wo_ext,total_threads]
+    @timed_stage('compress')
+    def compress_output(self, in_file_path, out_file_path):
         """
-        print("PLUGIN DEBUG MSG: Starting SyN ants registration stage ... ")
-        if len(args) == 0:
-            # Then this is a slave worker, need to read args from file first.
-            with open(self.args_file_path,'r') as args_file:
-                args_list = args_file.read().strip('\n').split('\n')
-                args["fixed_image_name"]  = args_list[0]
-                args["moving_image_name"] = args_list[1]
-                args["out_path"]          = args_list[2]
-                args["name_wo_ext"]       = args_list[3]
-                args["total_threads"]     = args_list[4]
-                args_file.close()
+        Compress in_file_path into out_file_path, which appears complete at once,
+        and remove in_file_path. Use pigz if it is installed, gzip_file otherwise,
+        with the threads of a worker.
+        """
+        threads = int(os.environ['ITK_THREADS_PER_WORKER'])
+        # Not named .gz, which might be out_file_path itself
+        suffix = '.gz.partial'
+        if shutil.which('pigz') is not None:
+            self.run_command_wrapper(['pigz', '-f', '-S', suffix, '-p', str(threads),
+                                      in_file_path], None,
+                                     out_file_path.split('/')[-1].split('.')[0],
+                                     get_image_voxels([in_file_path]))
+        else:
+            gzip_file(in_file_path, in_file_path + suffix, threads)
+            os.remove(in_file_path)
+        publish_file(in_file_path + suffix, out_file_path)
 
-        # Ants Registration Call 
-        self.run_bash_command_wrapper(self.ants_registration_command +
-                                      ' -d 3 -f {} -m {} -o {}/{} -n {} -t so' 
-                                      .format(args["fixed_image_name"],
-                                              args["moving_image_name"],
-                                              args["out_path"],
-                                              args["name_wo_ext"],
-                                              args["total_threads"]))
-        # Remove extra outputs
-        files_to_be_removed = [args["out_path"] + '/' + args["name_wo_ext"] + '1InverseWarp.nii.gz',
-                               args["out_path"] + '/' + args["name_wo_ext"] + '1Warp.nii.gz',
-                               args["out_path"] + '/' + args["name_wo_ext"] + 'InverseWarped.nii.gz',
-                               args["out_path"] + '/' + args["name_wo_ext"] + '0GenericAffine.mat']
-        for filename in files_to_be_removed:
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+    def run_in_background(self, function):
+        """
+        Run function in the background thread of this worker, used for work such
+        as making mosaics that nothing else waits for.
+        """
+        if self.background_executor is None:
+            self.background_executor = ThreadPoolExecutor(max_workers=1)
+            self.background_futures = []
+        self.background_futures.append(self.background_executor.submit(function))
 
-    def get_state(self):
+    def wait_for_background_tasks(self):
         """
-        Return the state of slave workeres (as given by master), either IDLE, EXIT, or START.
-        All slaves read from the same state file 'slave_state' in tmp_path.
-        This function should only be called by slave workeres.
+        Wait for everything started with run_in_background to finish.
         """
-        with self.slave_state_file_lock.acquire():
-            with open(self.slave_state_file_path,'r') as slave_state_file:
-                state = int(slave_state_file.read().strip())
-                slave_state_file.close()
-        return state
+        for future in self.background_futures:
+            if future.exception() is not None:
+                print("PLUGIN ERROR MSG: Background task failed: {}".format(future.exception()))
+        self.background_futures = []
 
-    def write_state(self, state):
+    @timed_stage('mosaic')
+    def make_tiled_mosaic_jpeg_wrapper(self,in_file_path, out_file_path, tmp_path):
         """
-        Write the state to the slave sate file in tmp_path 'slave_state'.
-        State must be EXIT, START, or IDLE.
-        Should only be called by master worker.
+        Make a JPEG mosaic of the slices of in_file_path. Rendered in process
+        when numpy, nibabel and Pillow are available, by CreateTiledMosaic and
+        ConvertToJpg otherwise, using tmp_path for the intermediate mosaic.
         """
-        with self.slave_state_file_lock.acquire():
-            with open(self.slave_state_file_path,'w') as slave_state_file:
-                slave_state_file.write(str(state))
-                slave_state_file.close()
+        if np is not None:
+            print("PLUGIN DEBUG MSG: Rendering mosaic of {}".format(in_file_path))
+            render_mosaic_jpeg(in_file_path, out_file_path)
+            return
+        # Set number of threads to one, since these apps were not proxess parallelized
+        env = self.get_env_for_single_threaded_execution()
+        # Intermediate mosaic is named after the output so that workers
+        # making mosaics at the same time do not overwrite each other's
+        tiled_file_path = '{}/{}.nii'.format(tmp_path,
+                                            out_file_path.split('/')[-1].split('.')[0])
+        log_name = out_file_path.split('/')[-1].split('.')[0]
+        voxels = get_image_voxels([in_file_path])
+        # Make JPEG image of fixed image
+        self.run_command_wrapper(['CreateTiledMosaic', '-i', in_file_path, '-o', tiled_file_path],
+                                 env, log_name, voxels)
+        self.run_command_wrapper(['ConvertToJpg', tiled_file_path, out_file_path],
+                                 env, log_name, voxels)
+        try:
+            os.remove(tiled_file_path)
+        except FileNotFoundError:
+            pass
 
-    def run_parallel_ants_registration_slave(self):
+    @timed_stage('dicom_conversion')
+    def dcm_to_nii_wrapper(self, nii_filename, dcm_input_dir_path):
         """
-        Must be called by slave workeres.
-        This function never returns, it exits python normally when an EXIT signal
-        is sent by the master worker.
-        The slave waits for START signal from master before running ants registration.
+        Convert the DICOM directory into <tmp_path>/<nii_filename>_nii/.
+        dcm2niix writes one volume per series, echo or anatomical plane found in the
+        directory, so return the sorted list of every NIFTI file it produced.
         """
-        state = self.IDLE
-        while state != self.EXIT:
+        nii_dir_path = '{}/{}_nii'.format(self.tmp_path, nii_filename)
+        converted = self.manifest.get(nii_filename).get("converted")
+        if converted and all(os.path.exists(self.tmp_path + '/' + name) for name in converted):
+            # Converted by a previous run
+            return [self.tmp_path + '/' + name for name in converted]
+        try:
+            os.mkdir(nii_dir_path)
+        except FileExistsError:
+            pass
+        self.run_command_wrapper(['dcm2niix',
+                                  '-o', nii_dir_path,
+                                  '-f', nii_filename,
+                                  dcm_input_dir_path],
+                                 None, nii_filename,
+                                 get_dicom_dir_voxels(dcm_input_dir_path))
+        nii_file_list = []
+        for name in sorted(os.listdir(nii_dir_path)):
+            if name.endswith('.nii') or name.endswith('.nii.gz'):
+                nii_file_list.append(nii_dir_path + '/' + name)
+        if len(nii_file_list) == 0:
+            print("PLUGIN ERROR MSG: dcm2niix produced no volume for {}"
+                  .format(dcm_input_dir_path))
+        else:
+            self.manifest.mark(nii_filename,
+                               converted=[file_path[len(self.tmp_path) + 1:]
+                                          for file_path in nii_file_list])
+        return nii_file_list
+
+    def convert_dicom_dirs(self, dicom_dir_list, in_path, conversion_jobs):
+        """
+        Generator converting the DICOM directories in dicom_dir_list, found in
+        in_path, with at most conversion_jobs dcm2niix processes at a time.
+        Yield the list of NIFTI files of each directory as soon as it is converted,
+        so that registration does not have to wait for the whole study.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, conversion_jobs)) as executor:
+            futures = {executor.submit(self.dcm_to_nii_wrapper, name, in_path + '/' + name): name
+                       for name in dicom_dir_list}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    # One bad series does not stop the others
+                    self.record_failure(futures[future], 'dicom_conversion', future.exception())
+                    continue
+                yield future.result()
+
+    def get_memory_limit(self, memory_limit_str):
+        """
+        Return the memory, in bytes, the commands of this worker may use at the
+        same time, 0 for no limit. See --memorylimit.
+        """
+        if memory_limit_str:
+            return parse_size(memory_limit_str)
+        if os.environ.get('MEMORY_LIMIT'):
+            limit = parse_size(os.environ['MEMORY_LIMIT'])
+        else:
+            limit = get_cgroup_memory_limit() or parse_size(self.MAX_MEMORY_LIMIT)
+        return int(limit * 0.9)
+
+    def watch_input_dir(self, watcher, in_path, conversion_jobs):
+        """
+        Generator yielding lists of NIFTI files to register as they arrive in
+        in_path, see InputWatcher: a NIFTI file once it is completely written,
+        the volumes of a DICOM directory once it is converted, with at most
+        conversion_jobs directories converted at the same time. Ends once the
+        watcher stops and every conversion is done.
+        """
+        ready = queue.Queue()
+        def convert(name):
             try:
-            	state = self.get_state()
-            except FileNotFoundError:
-                # Most likely because master hasn't created slave_state file yet
-                pass
-            if state == self.START:
-                self.syn_ants_registration_command_wrapper({})
-                # Wait for IDLE signal from master 
-                while state != self.IDLE:
-                    state = self.get_state()
-                    time.sleep(1)
-            print("PLUGIN DEBUG MSG: Waiting for master ... ")
-            time.sleep(1)
-        self.exit_worker()
+                ready.put(self.dcm_to_nii_wrapper(name, in_path + '/' + name))
+            except Exception as e:
+                self.record_failure(name, 'dicom_conversion', e)
+        def watch():
+            try:
+                with ThreadPoolExecutor(max_workers=max(1, conversion_jobs)) as executor:
+                    for name in watcher.watch():
+                        print("PLUGIN DEBUG MSG: New input {}".format(name))
+                        if os.path.isdir(in_path + '/' + name):
+                            executor.submit(convert, name)
+                        elif is_nifti_file_name(name):
+                            ready.put([in_path + '/' + name])
+            except Exception as e:
+                print("PLUGIN ERROR MSG: Stopped watching {}: {}".format(in_path, e))
+            finally:
+                ready.put(None)
+        threading.Thread(target=watch, daemon=True).start()
+        for nii_file_list in iter(ready.get, None):
+            yield nii_file_list
 
-    def write_args_to_file(self, args):
+    def get_conversion_jobs(self, options, schedule):
         """
-        Should only be called by master worker.
-        This method writes the arguments that need to be passed to the ants registration
-        command to file names 'args_file' so that slave workeres know what args to pass.
+        Return the number of dcm2niix processes that may run at the same time.
+        In syn scheduling, master converts next to its share of the SyN stages,
+        on the threads it keeps for that, see get_side_threads.
         """
-        with open(self.args_file_path,'w') as args_file:
-            args_file.write(args["fixed_image_name"])
-            args_file.write('\n')
-            args_file.write(args["moving_image_name"])
-            args_file.write('\n')
-            args_file.write(args["out_path"])
-            args_file.write('\n')
-            args_file.write(args["name_wo_ext"])
-            args_file.write('\n')
-            args_file.write(args["total_threads"])
-            args_file.write('\n')
-            args_file.close()
-        
-    def run_parallel_ants_registration_master(self, linear_ants_args, syn_ants_args):
+        if options.conversion_jobs > 0:
+            return options.conversion_jobs
+        if schedule == self.SCHEDULE_SYN and self.get_side_threads() > 0:
+            return self.get_side_threads()
+        return max(1, int(int(os.environ['CPU_LIMIT'].strip('m'))/1000))
+
+    def get_side_threads(self):
         """
-        Should only be called by master worker. 
-        This is executed when master worker is ready to run ants registration.
+        Return the threads master keeps, in syn scheduling, for the stages it
+        runs next to its share of a SyN stage: the linear stage of the next
+        image, DICOM conversion and mosaics, the latter on one thread each.
+        Every worker runs SyN at the pace of the slowest, so these stages take
+        1/SIDE_THREADS_SHARE of the threads of master rather than all of them.
+        Return 0 if master has fewer threads than SIDE_THREADS_SHARE: there are
+        no spare cores, and the linear stages and DICOM conversion do not run
+        next to SyN at all.
         """
-        # Run Linear stage with single worker
-        self.linear_ants_registration_command_wrapper(linear_ants_args)
-        # Run SyN stage with all workers
-        os.environ['ITK_NUMBER_OF_WORKERS'] = syn_ants_args["number_of_workers"]
-        self.write_args_to_file(syn_ants_args)
-        self.write_state(self.START)
-        self.syn_ants_registration_command_wrapper(syn_ants_args)
-        self.write_state(self.IDLE)
+        threads_per_worker = int(int(os.environ['CPU_LIMIT'].strip('m'))/1000)
+        return threads_per_worker // self.SIDE_THREADS_SHARE
 
-    def run_parallel_ants_registration_master_wrapper(self,
-                                                      fixed_image_name,
-                                                      moving_image_name,
-                                                      out_path):
+    def run_command_wrapper(self,argv,env=None,log_name='',voxels=None):
         """
-        Wrapper function that does preprocessing and postprocessing before 
-        ants registration proper.
-        ust be master to call.
+        Run argv through the command engine, logging its output to
+        logs/<log_name>.w<worker>.log in the output directory.
+        The timeout is the one of the current stage. Raise CommandError on failure.
+        voxels is the size of the images the command works on, from which the
+        memory budget estimates its peak memory; the command waits until that
+        much memory is available.
         """
-        name_wo_ext = moving_image_name.split('/')[-1].split('.')[0]
-        self.configure_env_for_multi_threaded_execution()
+        record = getattr(self.stage_local, 'record', None)
+        stage = record["stage"] if record is not None else ''
+        memory = 0
+        if self.memory_budget is not None:
+            memory = self.memory_budget.estimate(stage, voxels)
+            self.record_wait(self.memory_budget.acquire(memory))
+        print("PLUGIN DEBUG MSG: Running command: {}".format(' '.join(argv)))
+        try:
+            rusage = self.command_engine.run(argv, env, stage,
+                                             '{}.w{}'.format(log_name, self.worker_num))
+        finally:
+            if self.memory_budget is not None:
+                self.memory_budget.release(memory)
+        self.record_child_usage(rusage)
+        # ru_maxrss is in kilobytes on Linux
+        if self.memory_budget is not None and \
+           self.memory_budget.observe(stage, voxels, rusage.ru_maxrss * 1024):
+            self.record_memory_estimates()
 
-        linear_ants_args = {
-                            "fixed_image_name":   fixed_image_name,
-                            "moving_image_name":  moving_image_name,
-                            "out_path":           out_path,
-                            "name_wo_ext":        name_wo_ext,
-                            "number_of_workers":  '1',
-                            "total_threads":      os.environ['ITK_THREADS_PER_WORKER']
-                           }
-        # moving image for syn registration is output of linear registration
-        syn_ants_args    = {
-                            "fixed_image_name":   fixed_image_name,
-                            "moving_image_name":  out_path + '/' + name_wo_ext + 'Warped.nii.gz',
-                            "out_path":           out_path,
-                            "name_wo_ext":        name_wo_ext,
-                            "number_of_workers":  os.environ['ITK_NUMBER_OF_WORKERS'],
-                            "total_threads":      os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
-                           }
-        self.run_parallel_ants_registration_master(linear_ants_args, syn_ants_args)
-        
-        self.make_tiled_mosaic_jpeg_wrapper('{}/{}Warped.nii.gz'.format(out_path, name_wo_ext),
-                                            '{}/{}WarpedTiled.jpg'.format(out_path, name_wo_ext),
-                                            out_path)
-        # Remove extra outputs
-        files_to_be_removed = [out_path + '/' + name_wo_ext + 'WarpedTiled.nii']
-        for filename in files_to_be_removed:
-            try:
-                os.remove(filename)
-            except FileNotFoundError:
-                pass
+    def record_memory_estimates(self):
+        """
+        Report the bytes per voxel measured by the memory budget of this worker.
+        """
+        self.write_report({"kind":            "memory",
+                           "worker":          self.worker_num,
+                           "limit":           self.memory_budget.limit,
+                           "bytes_per_voxel": dict(self.memory_budget.measured)})
 
-    def make_tiled_mosaic_jpeg_wrapper(self,in_file_path, out_file_path, tmp_path):
-        # Set number of threads to one, since these apps were not proxess parallelized
-        self.configure_env_for_single_threaded_execution()
-        # Make JPEG image of fixed image
-        self.run_bash_command_wrapper('CreateTiledMosaic -i {} -o {}/FixedTiled.nii' 
-                                      .format(in_file_path, tmp_path))
-        self.run_bash_command_wrapper('ConvertToJpg {}/FixedTiled.nii {}'
-                                      .format(tmp_path, out_file_path))
-        os.remove(tmp_path + '/FixedTiled.nii')
+    def get_memory_report(self):
+        """
+        Should only be called by master worker, once every image is registered.
+        Return the memory budget of a worker and the largest bytes per voxel
+        measured by any worker for each stage.
+        """
+        bytes_per_voxel = {}
+        for report in self.read_reports("memory"):
+            for key, value in report["bytes_per_voxel"].items():
+                bytes_per_voxel[key] = max(bytes_per_voxel.get(key, 0), round(value, 1))
+        return {"limit":           self.memory_budget.limit,
+                "bytes_per_voxel": dict(sorted(bytes_per_voxel.items()))}
 
-    def dcm_to_nii_wrapper(self, nii_filename, dcm_input_dir_path):
+    @contextmanager
+    def stage_timer(self, stage, image=''):
+        """
+        Record the time spent in the body of the with statement as stage of image
+        in the timeline, along with CPU time and max RSS of the commands it ran
+        and time it spent waiting on locks or other workers.
         """
-        self.tmp_path assumed to be output directory.
+        record = {
+                  "stage":      stage,
+                  "image":      image,
+                  "worker":     self.worker_num,
+                  "thread":     threading.current_thread().name,
+                  "start":      time.time(),
+                  "wall":       0.0,
+                  "child_cpu":  0.0,
+                  "max_rss_kb": 0,
+                  "wait":       0.0
+                 }
+        parent = getattr(self.stage_local, 'record', None)
+        self.stage_local.record = record
+        try:
+            yield record
+        finally:
+            self.stage_local.record = parent
+            record["wall"]   = time.time() - record["start"]
+            record["worker"] = self.worker_num
+            self.write_timeline_record(record)
+
+    def record_child_usage(self, rusage):
+        """
+        Add the resource usage of a finished command to the current stage.
+        """
+        record = getattr(self.stage_local, 'record', None)
+        if record is None:
+            return
+        record["child_cpu"]  += rusage.ru_utime + rusage.ru_stime
+        record["max_rss_kb"]  = max(record["max_rss_kb"], rusage.ru_maxrss)
+
+    def record_wait(self, seconds):
+        """
+        Add time spent waiting on a lock or on other workers to the current stage.
+        """
+        record = getattr(self.stage_local, 'record', None)
+        if record is not None:
+            record["wait"] += seconds
+
+    @contextmanager
+    def locked(self, lock):
+        """
+        Acquire FileLock lock for the body of the with statement, recording
+        the time spent waiting for it.
+        """
+        start_time = time.time()
+        # A FileLock is shared by the threads of a process, so it does not keep
+        # them from each other; pair it with a lock of their own.
+        thread_lock = self.thread_locks.setdefault(lock.lock_file, threading.RLock())
+        with thread_lock, lock.acquire():
+            self.record_wait(time.time() - start_time)
+            yield
+
+    def write_timeline_record(self, record):
+        """
+        Append record to the timeline. Each record is written with a single
+        append, so records of workers running at the same time do not mix.
         """
-        self.run_bash_command_wrapper(
-                                      'dcm2niix -o {} -f {} {}'
-                                      .format(self.tmp_path,
-                                              nii_filename,
-                                              dcm_input_dir_path)
-                                     )
+        if self.coordinator is not None:
+            try:
+                self.coordinator.request('timeline', record=record)
+            except (OSError, CoordinatorError) as e:
+                print("PLUGIN DEBUG MSG: Could not send timeline record: {}".format(e))
+            return
+        if not self.timeline_file_path:
+            return
+        line = json.dumps(record) + '\n'
+        try:
+            fd = os.open(self.timeline_file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print("PLUGIN DEBUG MSG: Could not write timeline: {}".format(e))
 
-    def run_bash_command_wrapper(self,command_str):
-        print("PLUGIN DEBUG MSG: Running bash command: {}".format(command_str))
-        #subprocess.run(command_str.split())
-        subprocess.call(command_str, shell=True)
+    def get_timeline_summary(self):
+        """
+        Should only be called by master worker, once every image is registered.
+        Return the timeline summed up per stage.
+        """
+        summary = {}
+        try:
+            with open(self.timeline_file_path,'r') as timeline_file:
+                records = [json.loads(line) for line in timeline_file if line.strip()]
+                timeline_file.close()
+        except FileNotFoundError:
+            records = []
+        for record in records:
+            stage = summary.setdefault(record["stage"], {"count":      0,
+                                                         "wall":       0.0,
+                                                         "child_cpu":  0.0,
+                                                         "max_rss_kb": 0,
+                                                         "wait":       0.0})
+            stage["count"]      += 1
+            stage["wall"]       += record["wall"]
+            stage["child_cpu"]  += record["child_cpu"]
+            stage["max_rss_kb"]  = max(stage["max_rss_kb"], record["max_rss_kb"])
+            stage["wait"]       += record["wait"]
+        return {"file": self.timeline_file_path.split('/')[-1], "stages": summary}
 
-    def configure_env_for_single_threaded_execution(self):
-        os.environ['ITK_THREADS_PER_WORKER'] = '1'
-        os.environ['ITK_NUMBER_OF_WORKERS'] = '1'
-        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '1'
+    def get_env_for_single_threaded_execution(self):
+        """
+        Return a copy of the environment for running an ITK tool on a single
+        thread, leaving the environment of this worker untouched so that
+        stages running at the same time are not affected.
+        """
+        env = dict(os.environ)
+        env['ITK_THREADS_PER_WORKER'] = '1'
+        env['ITK_NUMBER_OF_WORKERS'] = '1'
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '1'
+        return env
 
     def configure_env_for_multi_threaded_execution(self):
         threads_per_worker = int(int(os.environ['CPU_LIMIT'].strip('m'))/1000)
@@ -372,6 +3704,17 @@ class AntsReg(ChrisApp):
         os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = \
           str(int(os.environ['NUMBER_OF_WORKERS']) * threads_per_worker)
 
+    def reset_barrier_files(self):
+        """
+        Should only be called by master worker, when no SyN stage runs.
+        Master worker must reset itkbarrier files to 0, at start and after a
+        SyN stage was killed in the middle.
+        """
+        for i in range(int(os.environ['NUMBER_OF_WORKERS'])):
+            with open(self.tmp_path + '/itkbarrier' + str(i),'wb+') as barrier_file:
+                barrier_file.write(b'\0'*8) #unsigned long
+                barrier_file.close()
+
     def run(self, options):
         """
         Execute default command. 
@@ -383,19 +3726,33 @@ class AntsReg(ChrisApp):
         * NUMBER_OF_WORKERS env variable set to positive number.
 
         DICOM files are converted to 3D NIFTI volume before image registration.
+        Up to -c directories are converted at the same time, and each volume is
+        registered as soon as its directory is converted.
         files without .dcm extension in DICOM directory are ignored.
-        Slices in single DICOM directory must be in same anatomical plane. If a DICOM directory
-        contians images from different anatomical plane, then it will be converted to 
-        multiple volumes. Only one of these volumes would be registered to fixed image.
+        If a DICOM directory contians several series, echoes or images from different
+        anatomical planes, then it will be converted to multiple volumes, and every
+        one of them is registered to fixed image. For the fixed image only the first
+        volume is used.
         
         Output Specifications:
         * FixedTiled.jpg is tiled representation of the fixed volume.
         * For each moving image, there are two outputs: <prefix>Warped.nii.gz 
           and <prefix>WarpedTiled.jpg. Prefix is name of input image stripped of file extension.
+        * With --affineinit --keepintermediate, <prefix>LinearWarped.nii.gz is the output
+          of the linear stages.
+        * logs/<prefix>.w<worker>.log holds the output of the commands run by a worker for
+          an image. Images whose commands fail or time out are left out and listed under
+          'failures' in the output meta data.
+        * antsreg_timeline.jsonl has one JSON record per stage run by any worker: stage,
+          image, worker, start time, wall time, CPU time and max RSS of the commands
+          it ran, and time spent waiting on locks or other workers.
 
-        Make sure output directory is world writable.
+        * antsreg_manifest.json records the stages completed for every image. If a run
+          crashes, run the plugin again with the same options: it clears the coordination
+          files the crashed run left in <output_dir>/tmp, once its master has been silent
+          for HEARTBEAT_TIMEOUT seconds, and skips every stage already completed.
 
-		If program crashes, remove <output_dir>/tmp manually.
+        Make sure output directory is world writable.
         """
         if options.fixed == None:
             self.error("A fixed image is required.")
@@ -417,16 +3774,61 @@ class AntsReg(ChrisApp):
         self.slave_state_file_path   = self.tmp_path + '/slave_state'
         self.slave_state_file_lock   = FileLock(self.tmp_path + '/slave_state.lock')
         self.args_file_path          = self.tmp_path + '/args_file'
-        try:
-            os.mkdir(self.tmp_path)
-        except FileExistsError:
-            pass
+        self.work_queue_file_path    = self.tmp_path + '/work_queue'
+        self.work_queue_file_lock    = FileLock(self.tmp_path + '/work_queue.lock')
+        self.master_address_file_path = self.tmp_path + '/master_address'
+        self.polling_workers_file_path = self.tmp_path + '/polling_workers'
+        self.heartbeat_file_path     = self.tmp_path + '/master_heartbeat'
+        self.timeline_file_path      = out_path + '/antsreg_timeline.jsonl'
+        self.out_path                = out_path
+        if not options.coordinator:
+            try:
+                os.mkdir(self.tmp_path)
+            except FileExistsError:
+                pass
 
         # Get worker number. worker #0 becomes master.
         master = False;
-        worker_num = self.get_worker_number()
+        self.join_deadline = options.join_deadline
+        if options.coordinator:
+            worker_num = self.join_coordinator(options.coordinator)
+        else:
+            worker_num = self.get_worker_number()
         if worker_num == 0:
             master = True
+        self.worker_num = worker_num
+        self.affine_init       = options.affine_init
+        self.keep_intermediate = options.keep_intermediate
+        self.voxels_per_thread = options.voxels_per_thread
+        self.speculation_factor = options.speculation_factor
+        if options.scratch_dir:
+            os.makedirs(options.scratch_dir, exist_ok=True)
+            self.scratch_path = tempfile.mkdtemp(prefix='antsreg_w{}_'.format(worker_num),
+                                                 dir=options.scratch_dir)
+        # Slaves in network coordinator mode work in their own tmp_path, master
+        # keeps the manifest and gathers the logs
+        manifest_path = out_path + '/antsreg_manifest.json'
+        log_path      = out_path + '/logs'
+        if self.coordinator is not None:
+            manifest_path = self.tmp_path + '/antsreg_manifest.json'
+            log_path      = self.tmp_path + '/out/logs'
+        self.command_engine = CommandEngine(options.max_commands,
+                                            parse_timeouts(options.timeouts),
+                                            log_path)
+        memory_limit = self.get_memory_limit(options.memory_limit)
+        if memory_limit > 0:
+            speed = 'slow' if self.ants_registration_command == 'antsRegistrationSyN.sh' else 'fast'
+            self.memory_budget = MemoryBudget(memory_limit, speed)
+        self.manifest = JobManifest(manifest_path,
+                                    self.tmp_path + '/manifest.lock',
+                                    {"fixed":        options.fixed,
+                                     "fixed_source": self.get_fixed_signature(in_path + '/' +
+                                                                              options.fixed),
+                                     "command":      self.ants_registration_command,
+                                     "affine_init":  self.affine_init})
+        if options.cachedir:
+            self.registration_cache = RegistrationCache(options.cachedir,
+                                                        parse_size(options.cachesize))
         os.environ['ITK_WORKER_NUMBER'] = str(worker_num)
         os.environ['ITK_BARRIER_FILE_PREFIX'] = self.tmp_path + '/itkbarrier'
         os.environ['ITK_DATA_FILE_PREFIX']    = self.tmp_path + '/itkdata'
@@ -439,11 +3841,7 @@ class AntsReg(ChrisApp):
         else:
             # Slaves never return from this function.
             self.run_parallel_ants_registration_slave();
-        # Master worker must reset itkbarrier files to 0
-        for i in range(int(os.environ['NUMBER_OF_WORKERS'])):
-            with open(self.tmp_path + '/itkbarrier' + str(i),'wb+') as barrier_file:
-                barrier_file.write(b'\0'*8) #unsigned long
-                barrier_file.close()
+        self.reset_barrier_files()
 
         # Variables below store abosolute file paths
         fixed_image_name = ''           # Filename for fixed image
@@ -453,38 +3851,65 @@ class AntsReg(ChrisApp):
             fixed_image_name = in_path + '/' + options.fixed
         else:
             # Fixed image is a directory. Assume to contain .dcm files
-            fixed_image_name = 'fixed_image'
-            self.dcm_to_nii_wrapper(fixed_image_name, in_path + '/' + options.fixed)
-            fixed_image_name = self.tmp_path + '/fixed_image.nii'
+            fixed_image_name = self.convert_fixed_image(in_path + '/' + options.fixed)
 
-        for name in os.listdir(in_path):
+        dicom_dir_list = []             # Names of DICOM directories holding moving images
+        # In watch mode every moving image comes from the watcher
+        for name in os.listdir(in_path) if not options.watch else []:
             if name == options.fixed or name == fixed_image_name: 
                 continue
             if not os.path.isfile(in_path + '/' + name):
                 # Assume to be directory full of .dcm slices
-                self.dcm_to_nii_wrapper(name, in_path + '/' + name)
-                # dcm2niix might output multiple nifti files, but we'll assume there is only one
-                moving_image_list.append(self.tmp_path + '/' + name+'.nii')
+                dicom_dir_list.append(name)
+            elif is_nifti_file_name(name):
+                moving_image_list.append(in_path + '/' + name)
 
-            else:
-                filename_split = name.strip().split('.')
-                if len(filename_split) > 1 and filename_split[-1] == 'nii':   # .nii extension
-                    moving_image_list.append(in_path + '/' + name)
-                elif len(filename_split) > 2 and filename_split[-2] == 'nii': # .nii.gz extension
-                    moving_image_list.append(in_path + '/' + name)
-
-        self.make_tiled_mosaic_jpeg_wrapper(fixed_image_name,
-                                            '{}/FixedTiled.jpg'.format(out_path),
-                                            out_path)
-        # Run ANTS registration on each of the moving images and create JPEG Tiled image
-        for moving_image_name in moving_image_list:
-            print("PLUGIN DEBUG MSG: Registering {} to {} ... "
-                  .format(moving_image_name, fixed_image_name))
-            self.run_parallel_ants_registration_master_wrapper(fixed_image_name,
-                                                               moving_image_name,
-                                                               out_path)
+        schedule = self.choose_schedule(options.schedule, moving_image_list + dicom_dir_list)
+        if self.coordinator_address is not None:
+            # Workers share no files, so they cannot share a SyN stage either
+            schedule = self.SCHEDULE_IMAGE
+            self.staging_roots = [in_path, self.tmp_path]
+        print("PLUGIN DEBUG MSG: Using {} scheduling for {} moving images and {} workers."
+              .format(schedule, len(moving_image_list) + len(dicom_dir_list),
+                      os.environ['NUMBER_OF_WORKERS']))
+        conversion_jobs = self.get_conversion_jobs(options, schedule)
+        pending_images = None           # Lists of NIFTI files ready later
+        if options.watch:
+            pending_images = self.watch_input_dir(InputWatcher(in_path, [options.fixed],
+                                                               options.settle_time,
+                                                               options.idle_timeout,
+                                                               options.sentinel),
+                                                  in_path, conversion_jobs)
+        elif len(dicom_dir_list) > 0:
+            pending_images = self.convert_dicom_dirs(dicom_dir_list, in_path, conversion_jobs)
+            if schedule == self.SCHEDULE_SYN and self.get_side_threads() == 0:
+                # No spare cores to convert next to the SyN stages, convert first
+                for nii_file_list in pending_images:
+                    moving_image_list.extend(nii_file_list)
+                pending_images = None
+        if schedule == self.SCHEDULE_IMAGE:
+            self.run_in_background(lambda: self.make_fixed_mosaic(fixed_image_name, out_path))
+            # Every worker registers whole images and creates JPEG Tiled image
+            self.run_work_queue_master(fixed_image_name, moving_image_list, pending_images,
+                                       out_path)
+        else:
+            # Run ANTS registration on each of the moving images and create JPEG Tiled image,
+            # overlapping the stages that only need the master with the SyN stages
+            self.run_pipelined_master(fixed_image_name, moving_image_list, pending_images,
+                                      out_path)
+        self.OUTPUT_META_DICT = {}
+        self.OUTPUT_META_DICT['timeline'] = self.get_timeline_summary()
+        self.OUTPUT_META_DICT['failures'] = self.get_failure_report()
+        self.OUTPUT_META_DICT['allocation'] = self.get_allocation_report()
+        self.OUTPUT_META_DICT['resumed'] = self.get_resume_report()
+        if self.memory_budget is not None:
+            self.OUTPUT_META_DICT['memory'] = self.get_memory_report()
+        if self.registration_cache is not None:
+            self.OUTPUT_META_DICT['registration_cache'] = self.get_cache_report()
+        if schedule == self.SCHEDULE_IMAGE:
+            self.OUTPUT_META_DICT['speculation'] = self.get_speculation_report()
         self.write_state(self.EXIT)  # Terminate slave workeres
-        self.exit_worker()
+        self.exit_worker(exit_process=False)
 
 # ENTRYPOINT
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+#                                                            _
+# antsreg benchmark
+#
+# (c) 2016 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Measure the coordination overhead of the antsreg plugin, apart from ANTs compute.
+
+Stub versions of antsRegistrationSyNQuick.sh, antsRegistrationSyN.sh,
+antsRegistration, CreateTiledMosaic, ConvertToJpg and dcm2niix, which only
+sleep for a configurable time and write their outputs, are put first on PATH.
+NUMBER_OF_WORKERS antsreg processes are then started on this machine with a
+shared output directory, as pman would start them on a cluster.
+
+For every combination of worker count, image count and scheduling mode,
+report end-to-end time, time to rendezvous (from the timeline written by
+the plugin) and overhead per image, i.e. end-to-end time minus the time
+the stubs would take with perfect scheduling, divided by the image count.
+
+Example:
+
+    python3 bench/bench_antsreg.py --workers 1,2,4 --images 4,16 --schedule syn,image
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ANTSREG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'antsreg', 'antsreg.py')
+
+# Stubs write a copy of the moving image wherever a NIFTI output is expected,
+# so that the in-process mosaic renderer gets a valid volume.
+STUB_COMMON = '''#!/usr/bin/env python3
+import os, sys, time, gzip, shutil
+def put(src, dst):
+    if os.path.abspath(src) == os.path.abspath(dst):
+        # SyN stage warping the output of the linear stage in place
+        return
+    if dst.endswith('.gz') and not src.endswith('.gz'):
+        with open(src, 'rb') as f, gzip.open(dst, 'wb', compresslevel=1) as g:
+            shutil.copyfileobj(f, g)
+    elif src.endswith('.gz') and not dst.endswith('.gz'):
+        with gzip.open(src, 'rb') as f, open(dst, 'wb') as g:
+            shutil.copyfileobj(f, g)
+    else:
+        shutil.copyfile(src, dst)
+def arg(flag):
+    return sys.argv[sys.argv.index(flag) + 1]
+'''
+
+STUBS = {
+    'antsRegistrationSyNQuick.sh': STUB_COMMON + '''
+time.sleep(float(os.environ['STUB_ANTS_LATENCY']))
+prefix = arg('-o')
+put(arg('-m'), prefix + 'Warped.nii.gz')
+put(arg('-m'), prefix + 'InverseWarped.nii.gz')
+open(prefix + '0GenericAffine.mat', 'w').close()
+if arg('-t') == 'so':
+    put(arg('-m'), prefix + '1Warp.nii.gz')
+    put(arg('-m'), prefix + '1InverseWarp.nii.gz')
+''',
+    'antsRegistration': STUB_COMMON + '''
+time.sleep(float(os.environ['STUB_ANTS_LATENCY']))
+output = arg('--output')
+# --initial-moving-transform is a transform file with --affineinit, --metric always
+# names the moving image
+moving = arg('--metric').split('[', 1)[1].split(',')[1]
+if output.startswith('['):
+    output, warped = output.strip('[]').split(',')[:2]
+    put(moving, warped)
+open(output + '0GenericAffine.mat', 'w').close()
+''',
+    'CreateTiledMosaic': STUB_COMMON + '''
+time.sleep(float(os.environ['STUB_MOSAIC_LATENCY']))
+put(arg('-i'), arg('-o'))
+''',
+    'ConvertToJpg': STUB_COMMON + '''
+time.sleep(float(os.environ['STUB_MOSAIC_LATENCY']))
+open(sys.argv[2], 'wb').write(b'\\xff\\xd8\\xff\\xd9')
+''',
+    'dcm2niix': STUB_COMMON + '''
+time.sleep(float(os.environ['STUB_DCM_LATENCY']))
+dicom_dir = sys.argv[-1]
+put(os.path.join(dicom_dir, 'volume.nii'), os.path.join(arg('-o'), arg('-f') + '.nii'))
+''',
+}
+STUBS['antsRegistrationSyN.sh'] = STUBS['antsRegistrationSyNQuick.sh']
+
+
+def write_nifti(file_path, size):
+    """
+    Write a size^3 float32 NIFTI-1 volume holding a gradient, without numpy or nibabel.
+    """
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, 3, size, size, size, 1, 1, 1, 1)
+    struct.pack_into('<hh', header, 70, 16, 32)                 # datatype float32, bitpix
+    struct.pack_into('<8f', header, 76, 1, 1, 1, 1, 1, 1, 1, 1) # pixdim
+    struct.pack_into('<f', header, 108, 352)                    # vox_offset
+    struct.pack_into('<f', header, 112, 1)                      # scl_slope
+    header[344:348] = b'n+1\0'
+    data = struct.pack('<{}f'.format(size ** 3), *[float(i % 97) for i in range(size ** 3)])
+    with open(file_path, 'wb') as nifti_file:
+        nifti_file.write(bytes(header) + b'\0' * 4 + data)
+
+
+def make_inputs(in_path, number_of_images, number_of_dicom_dirs, size):
+    """
+    Make a fixed image, number_of_images NIFTI moving images and number_of_dicom_dirs
+    fake DICOM directories, which the dcm2niix stub turns into volumes.
+    """
+    os.makedirs(in_path)
+    write_nifti(os.path.join(in_path, 'fixed.nii'), size)
+    for i in range(number_of_images - number_of_dicom_dirs):
+        # Vary sizes a little so that largest-first ordering has something to do
+        write_nifti(os.path.join(in_path, 'moving{:03d}.nii'.format(i)), size + i % 4)
+    for i in range(number_of_dicom_dirs):
+        dicom_dir = os.path.join(in_path, 'series{:03d}'.format(i))
+        os.makedirs(dicom_dir)
+        write_nifti(os.path.join(dicom_dir, 'volume.nii'), size)
+        open(os.path.join(dicom_dir, 'slice0001.dcm'), 'wb').close()
+
+
+def ideal_time(options, number_of_workers, number_of_images, schedule):
+    """
+    Return the time the stubs need with perfect scheduling and no coordination cost.
+    In syn scheduling images go through SyN one after the other, the first linear
+    stage and the last mosaic being the only stages off the overlap.
+    In image scheduling every worker registers its share of the images on its own.
+    """
+    per_image = 2 * options.ants_latency + options.mosaic_latency
+    if schedule == 'image' or (schedule == 'auto' and number_of_images >= number_of_workers > 1):
+        rounds = -(-number_of_images // number_of_workers)
+        return rounds * per_image
+    return options.ants_latency * (number_of_images + 1) + options.mosaic_latency
+
+
+def read_rendezvous_time(out_path):
+    """
+    Return the longest rendezvous stage found in the timeline written by the plugin.
+    """
+    timeline_file_path = os.path.join(out_path, 'antsreg_timeline.jsonl')
+    rendezvous = 0.0
+    try:
+        with open(timeline_file_path) as timeline_file:
+            for line in timeline_file:
+                record = json.loads(line)
+                if record["stage"] == 'rendezvous':
+                    rendezvous = max(rendezvous, record["wall"])
+    except FileNotFoundError:
+        pass
+    return rendezvous
+
+
+def run_case(options, work_path, number_of_workers, number_of_images, schedule):
+    """
+    Run the plugin with number_of_workers processes on number_of_images images
+    and return the measurements.
+    """
+    case_path = os.path.join(work_path, 'w{}_i{}_{}'.format(number_of_workers,
+                                                           number_of_images, schedule))
+    in_path  = os.path.join(case_path, 'in')
+    out_path = os.path.join(case_path, 'out')
+    number_of_dicom_dirs = int(number_of_images * options.dicom_fraction)
+    make_inputs(in_path, number_of_images, number_of_dicom_dirs, options.size)
+    os.makedirs(out_path)
+
+    env = dict(os.environ)
+    env['PATH']                = os.path.join(work_path, 'bin') + os.pathsep + env['PATH']
+    env['NUMBER_OF_WORKERS']   = str(number_of_workers)
+    env['CPU_LIMIT']           = options.cpu_limit
+    env['STUB_ANTS_LATENCY']   = str(options.ants_latency)
+    env['STUB_MOSAIC_LATENCY'] = str(options.mosaic_latency)
+    env['STUB_DCM_LATENCY']    = str(options.dcm_latency)
+    command = [sys.executable, ANTSREG_PATH, in_path, out_path,
+               '-f', 'fixed.nii', '-p', schedule] + options.extra_args.split()
+
+    start_time = time.time()
+    processes = []
+    for worker in range(number_of_workers):
+        log_file = open(os.path.join(case_path, 'worker{}.log'.format(worker)), 'w')
+        processes.append((subprocess.Popen(command, env=env, stdout=log_file,
+                                           stderr=subprocess.STDOUT), log_file))
+    return_codes = []
+    for process, log_file in processes:
+        return_codes.append(process.wait())
+        log_file.close()
+    end_to_end = time.time() - start_time
+
+    registered = len([name for name in os.listdir(out_path) if name.endswith('WarpedTiled.jpg')])
+    ideal = ideal_time(options, number_of_workers, number_of_images, schedule)
+    return {
+            "workers":          number_of_workers,
+            "images":           number_of_images,
+            "schedule":         schedule,
+            "end_to_end":       end_to_end,
+            "rendezvous":       read_rendezvous_time(out_path),
+            "ideal":            ideal,
+            "overhead_per_image": (end_to_end - ideal) / number_of_images,
+            "registered":       registered,
+            "ok":               all(code == 0 for code in return_codes) and
+                                registered == number_of_images,
+            "logs":             case_path
+           }
+
+
+def install_stubs(bin_path):
+    os.makedirs(bin_path)
+    for name, source in STUBS.items():
+        stub_path = os.path.join(bin_path, name)
+        with open(stub_path, 'w') as stub_file:
+            stub_file.write(source)
+        os.chmod(stub_path, 0o755)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark antsreg coordination overhead '
+                                                 'with stub ANTs and dcm2niix binaries.')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='Comma separated NUMBER_OF_WORKERS values.')
+    parser.add_argument('--images', default='4,16',
+                        help='Comma separated moving image counts.')
+    parser.add_argument('--schedule', default='syn,image',
+                        help='Comma separated scheduling modes passed to -p.')
+    parser.add_argument('--ants-latency', type=float, default=0.5,
+                        help='Seconds each stub ants registration stage takes.')
+    parser.add_argument('--mosaic-latency', type=float, default=0.05,
+                        help='Seconds CreateTiledMosaic and ConvertToJpg stubs take.')
+    parser.add_argument('--dcm-latency', type=float, default=0.2,
+                        help='Seconds the dcm2niix stub takes.')
+    parser.add_argument('--dicom-fraction', type=float, default=0.0,
+                        help='Fraction of moving images given as DICOM directories.')
+    parser.add_argument('--size', type=int, default=32,
+                        help='Edge length of the synthetic volumes.')
+    parser.add_argument('--cpu-limit', default='1000m',
+                        help='CPU_LIMIT given to every worker.')
+    parser.add_argument('--extra-args', default='',
+                        help='Extra arguments passed to antsreg.py.')
+    parser.add_argument('--json', dest='json_path', default='',
+                        help='Also write the results to this JSON file.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the working directory with inputs, outputs and logs.')
+    options = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix='antsreg_bench_')
+    install_stubs(os.path.join(work_path, 'bin'))
+    results = []
+    print('{:>7} {:>6} {:>8} {:>10} {:>10} {:>10} {:>12}  {}'
+          .format('workers', 'images', 'schedule', 'e2e (s)', 'ideal (s)',
+                  'rdv (s)', 'ovh/img (s)', 'status'))
+    try:
+        for number_of_workers in [int(w) for w in options.workers.split(',')]:
+            for number_of_images in [int(i) for i in options.images.split(',')]:
+                for schedule in options.schedule.split(','):
+                    result = run_case(options, work_path, number_of_workers,
+                                      number_of_images, schedule)
+                    results.append(result)
+                    print('{workers:>7} {images:>6} {schedule:>8} {end_to_end:>10.2f} '
+                          '{ideal:>10.2f} {rendezvous:>10.2f} {overhead_per_image:>12.3f}  '
+                          .format(**result) +
+                          ('ok' if result["ok"] else 'FAILED, see ' + result["logs"]))
+                    sys.stdout.flush()
+    finally:
+        if options.json_path:
+            with open(options.json_path, 'w') as json_file:
+                json.dump(results, json_file, indent=2)
+        if options.keep or not all(result["ok"] for result in results):
+            print('Working directory kept in {}'.format(work_path))
+        else:
+            shutil.rmtree(work_path)
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+
+if __name__ == '__main__':
+    main()